@@ -0,0 +1,328 @@
+"""
+Handler Benchmark
+
+Runs /current_note, /note, /delete_note and /note_replies against the local
+fake Instagram backend (fake_instagram.py) with synthetic Telegram updates, and
+reports p50/p95 latency and Instagram requests per command while the number of
+accounts and the size of their inboxes grow.
+
+Every scenario (accounts × inbox size) runs in a fresh process with its own
+temporary session files and database; nothing reaches Telegram or Instagram.
+Multi-account /note and /delete_note include pressing the account button.
+/current_note is measured with an empty notes cache (one tray fetch per
+account) and again as current_note_cached, answered from the cache.
+Logging in and the first /note_replies (which reads every inbox in full) are
+timed once per scenario; the per-command numbers are the steady state after.
+
+Usage:
+    python benchmark.py
+    python benchmark.py --accounts 1,10,50,100,200 --inbox 5x10,20x30,50x50 --iterations 30
+    python benchmark.py --output new.json --baseline benchmark.json
+    python benchmark.py --compare new.json --baseline benchmark.json
+
+Results are written as JSON (--output). With --baseline, every result is
+compared to the matching one in the baseline file; a p95 more than --tolerance
+slower, or more Instagram requests per command, counts as a regression and
+makes the script exit with status 1.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import asyncio
+import argparse
+import platform
+import itertools
+import subprocess
+import tempfile
+from datetime import datetime, timezone
+from pathlib import Path
+
+# current_note fetches every tray; current_note_cached is the same command inside NOTES_CACHE_TTL
+COMMANDS = ('current_note', 'current_note_cached', 'note', 'delete_note', 'note_replies')
+USER_ID = 1
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p * len(ordered)) - 1)]
+
+# ==================== Scenario (runs in its own process) ====================
+class RecordingBot:
+    """Stands in for telegram.Bot: keeps what the handlers send instead of calling Telegram."""
+
+    def __init__(self):
+        self.message_ids = itertools.count(1)
+        self.sent = []
+
+    def message(self, chat_id, text, reply_markup=None, message_id=None):
+        from telegram import Chat, Message
+        message = Message(message_id or next(self.message_ids), datetime.now(timezone.utc),
+                          Chat(chat_id, Chat.PRIVATE), text=text, reply_markup=reply_markup)
+        message.set_bot(self)
+        self.sent.append(message)
+        return message
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        return self.message(chat_id, text, reply_markup)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, reply_markup=None, **kwargs):
+        return self.message(chat_id, text, reply_markup, message_id)
+
+    async def answer_callback_query(self, callback_query_id, **kwargs):
+        return True
+
+class Context:
+    """The part of CallbackContext the handlers use."""
+
+    def __init__(self, bot, args=()):
+        self.bot = bot
+        self.args = list(args)
+
+def command_update(bot, update_id, text):
+    from telegram import Chat, Message, MessageEntity, Update, User
+    message = Message(update_id, datetime.now(timezone.utc), Chat(USER_ID, Chat.PRIVATE),
+                      from_user=User(USER_ID, 'Bench', False), text=text,
+                      entities=[MessageEntity(MessageEntity.BOT_COMMAND, 0, len(text.split()[0]))])
+    message.set_bot(bot)
+    return Update(update_id, message=message)
+
+def button_update(bot, update_id, keyboard, index):
+    """The update Telegram sends when the button for account number `index` is pressed."""
+    from telegram import CallbackQuery, Update, User
+    button = next(b for row in keyboard.reply_markup.inline_keyboard for b in row
+                  if b.callback_data.endswith(f":{index}"))
+    query = CallbackQuery(str(update_id), User(USER_ID, 'Bench', False), 'bench',
+                          data=button.callback_data, message=keyboard)
+    query.set_bot(bot)
+    return Update(update_id, callback_query=query)
+
+async def run_scenario(spec):
+    import logging
+    import bot
+    import fake_instagram
+    logging.disable(logging.INFO)  # a log line per request would be measured along with the handlers
+
+    fake = fake_instagram.FakeInstagram(latency=spec['latency'], jitter=spec['jitter'], threads=spec['threads'],
+                                        messages=spec['messages'], seed=1)
+    server, url = fake_instagram.start_in_background(fake)
+    bot.INSTAGRAM_API_URL = url  # set before start_shards, the shards get it from the environment
+    os.environ['INSTAGRAM_API_URL'] = url
+
+    recorder = RecordingBot()
+    update_ids = itertools.count(1)
+    bot.init_db()
+    bot.start_shards()
+    bot.start_write_workers(recorder)
+
+    async def send(command, *args):
+        text = ' '.join((f"/{command}",) + args)
+        handler = bot.note if command == 'note' else getattr(bot, command)
+        before = len(recorder.sent)
+        await handler(command_update(recorder, next(update_ids), text), Context(recorder, args))
+        return recorder.sent[before] if len(recorder.sent) > before else None
+
+    async def press(keyboard, index):
+        await bot.handle_account_choice(button_update(recorder, next(update_ids), keyboard, index), Context(recorder))
+
+    async def single(command, i, *args):
+        """/note or /delete_note for account number i, with the button press if there is a choice."""
+        reply = await send(command, *args)
+        if reply is not None and reply.reply_markup:
+            await press(reply, i % len(bot.account_list))
+
+    def requests():
+        totals = {}
+        with fake.lock:
+            for per_user in fake.stats.values():
+                for endpoint, count in per_user.items():
+                    totals[endpoint] = totals.get(endpoint, 0) + count
+        return totals
+
+    # Log every account in and read every inbox once; both are reported apart from the steady-state numbers
+    started = time.perf_counter()
+    await send('current_note')
+    login_seconds = time.perf_counter() - started
+    for name in bot.account_list:
+        fake.inbox(fake.user(bot.accounts[name]['username']))
+    before = sum(requests().values())
+    started = time.perf_counter()
+    await send('note_replies')
+    cold_replies_seconds = time.perf_counter() - started
+    cold_replies_calls = sum(requests().values()) - before
+
+    steps = {
+        'current_note': lambda i: send('current_note'),
+        'current_note_cached': lambda i: send('current_note'),
+        'note': lambda i: single('note', i, f"bench {i}"),
+        'delete_note': lambda i: single('delete_note', i),
+        'note_replies': lambda i: send('note_replies'),
+    }
+    results = []
+    for command in COMMANDS:
+        latencies = []
+        endpoints = {}
+        for i in range(spec['iterations']):
+            # Untimed setup: an empty notes cache, a note to delete, or a new message to find
+            if command == 'current_note':
+                bot.notes_cache.clear()
+            elif command == 'delete_note':
+                await single('note', i, f"bench {i}")
+            elif command == 'note_replies':
+                fake.add_reply(bot.accounts[bot.account_list[i % len(bot.account_list)]]['username'], f"reply {i}")
+            before = requests()
+            started = time.perf_counter()
+            await steps[command](i)
+            latencies.append(time.perf_counter() - started)
+            for endpoint, count in requests().items():
+                if count > before.get(endpoint, 0):
+                    endpoints[endpoint] = endpoints.get(endpoint, 0) + count - before.get(endpoint, 0)
+        results.append({
+            'command': command,
+            'accounts': spec['accounts'],
+            'threads': spec['threads'],
+            'messages': spec['messages'],
+            'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'mean_ms': round(sum(latencies) / len(latencies) * 1000, 2),
+            'ig_calls': round(sum(endpoints.values()) / spec['iterations'], 2),
+            'ig_endpoints': {endpoint: round(count / spec['iterations'], 2) for endpoint, count in sorted(endpoints.items())},
+        })
+
+    bot.stop_shards()
+    server.shutdown()
+    return {'login_ms': round(login_seconds * 1000, 2), 'results': results,
+            'cold_replies_ms': round(cold_replies_seconds * 1000, 2), 'cold_replies_ig_calls': cold_replies_calls,
+            'settings': {'FANOUT_CONCURRENCY': bot.FANOUT_CONCURRENCY, 'IG_WORKERS': bot.IG_WORKERS,
+                         'SHARDS': bot.SHARDS, 'NOTES_CACHE_TTL': bot.NOTES_CACHE_TTL}}
+
+def child(spec):
+    outcome = asyncio.run(run_scenario(spec))
+    Path(spec['result_file']).write_text(json.dumps(outcome))
+
+# ==================== Runner ====================
+def scenario_env(spec, workdir):
+    env = dict(os.environ)
+    env.update({
+        'TELEGRAM_BOT_TOKEN': 'benchmark',
+        'ALLOWED_TELEGRAM_USER_ID': str(USER_ID),
+        'INSTA_ACCOUNTS': '|'.join(f"acc{i}=bench{i}:password" for i in range(spec['accounts'])),
+        'INSTAGRAM_API_URL': 'http://127.0.0.1:9',  # replaced by the scenario's own fake backend
+        'BOT_DB': str(workdir / 'bot.db'),
+        'USER_CACHE_FILE': str(workdir / 'user_cache.json'),
+        'REPLY_CURSORS_FILE': str(workdir / 'reply_cursors.json'),
+        'OWN_NOTES_FILE': str(workdir / 'own_notes.json'),
+        'WARM_UP': '0',
+        'REPLY_POLL': '0',
+        # The rate limiter would dominate every number; it's not what's being measured
+        'IG_RATE': '1000000',
+        'IG_BURST': '1000000',
+        'SHARDS': str(spec['shards']),
+    })
+    return env
+
+def run(spec):
+    with tempfile.TemporaryDirectory(prefix='notes-bench-') as workdir:
+        workdir = Path(workdir)
+        spec = dict(spec, result_file=str(workdir / 'result.json'))
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', json.dumps(spec)],
+                              cwd=workdir, env=scenario_env(spec, workdir), capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise RuntimeError(f"scenario {spec['accounts']} accounts, {spec['threads']}x{spec['messages']} inbox "
+                               f"failed:\n{proc.stderr[-3000:]}")
+        return json.loads((workdir / 'result.json').read_text())
+
+def key(result):
+    return result['command'], result['accounts'], result['threads'], result['messages']
+
+def compare(results, baseline, tolerance, min_delta_ms):
+    """Print each result next to its baseline; returns the number of regressions."""
+    old = {key(r): r for r in baseline['results']}
+    regressions = 0
+    for result in results:
+        before = old.get(key(result))
+        if before is None:
+            continue
+        slower = (result['p95_ms'] > before['p95_ms'] * (1 + tolerance)
+                  and result['p95_ms'] - before['p95_ms'] >= min_delta_ms)
+        more_calls = result['ig_calls'] > before['ig_calls'] + 0.01
+        flags = [f"p95 {before['p95_ms']:.1f} → {result['p95_ms']:.1f} ms"] if slower else []
+        if more_calls:
+            flags.append(f"Instagram requests {before['ig_calls']:g} → {result['ig_calls']:g}")
+        if flags:
+            regressions += 1
+            print(f"❌ {result['command']} ({result['accounts']} accounts, {result['threads']}x{result['messages']}): "
+                  + ", ".join(flags))
+    missing = len(results) - sum(key(r) in old for r in results)
+    print(f"\n{regressions} regression(s) against the baseline"
+          + (f", {missing} result(s) without a baseline entry" if missing else ""))
+    return regressions
+
+def print_table(results):
+    print(f"{'command':<21}{'accounts':>9}{'inbox':>8}{'p50 ms':>10}{'p95 ms':>10}{'IG calls':>10}")
+    for r in results:
+        print(f"{r['command']:<21}{r['accounts']:>9}{r['threads']:>4}x{r['messages']:<3}"
+              f"{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['ig_calls']:>10g}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bot's handlers against the fake Instagram backend")
+    parser.add_argument('--accounts', default='1,10,50,200', help="comma-separated account counts")
+    parser.add_argument('--inbox', default='5x10,20x30', help="comma-separated THREADSxMESSAGES inbox sizes")
+    parser.add_argument('--iterations', type=int, default=20, help="runs of each command per scenario")
+    parser.add_argument('--latency', type=float, default=0, help="milliseconds the fake backend adds to every request")
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--shards', type=int, default=0, help="SHARDS setting for the bot")
+    parser.add_argument('--output', default='benchmark.json', help="where to write the results")
+    parser.add_argument('--baseline', help="earlier results to compare against")
+    parser.add_argument('--compare', help="compare this results file to --baseline without running anything")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed p95 slowdown, as a fraction")
+    parser.add_argument('--min-delta-ms', type=float, default=2.0, help="ignore p95 slowdowns smaller than this")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(json.loads(args.child))
+        return
+    if args.compare:
+        if not args.baseline:
+            parser.error("--compare needs --baseline")
+        results = json.loads(Path(args.compare).read_text())['results']
+        print_table(results)
+        sys.exit(1 if compare(results, json.loads(Path(args.baseline).read_text()),
+                              args.tolerance, args.min_delta_ms) else 0)
+
+    inboxes = [tuple(int(n) for n in size.lower().split('x')) for size in args.inbox.split(',')]
+    scenarios = []
+    for accounts, (threads, messages) in itertools.product(
+            [int(n) for n in args.accounts.split(',')], inboxes):
+        spec = {'accounts': accounts, 'threads': threads, 'messages': messages, 'iterations': args.iterations,
+                'latency': args.latency, 'jitter': args.jitter, 'shards': args.shards}
+        print(f"Running {accounts} account(s), {threads}x{messages} inbox...", flush=True)
+        outcome = run(spec)
+        scenarios.append({'accounts': accounts, 'threads': threads, 'messages': messages,
+                          'login_ms': outcome['login_ms'], 'cold_replies_ms': outcome['cold_replies_ms'],
+                          'cold_replies_ig_calls': outcome['cold_replies_ig_calls'], 'settings': outcome['settings']})
+        print_table(outcome['results'])
+        print(f"(logging in: {outcome['login_ms']:.0f} ms, first /note_replies: {outcome['cold_replies_ms']:.0f} ms "
+              f"and {outcome['cold_replies_ig_calls']} Instagram requests)")
+        scenarios[-1]['results'] = outcome['results']
+
+    results = [r for scenario in scenarios for r in scenario['results']]
+    report = {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'iterations': args.iterations,
+        'latency_ms': args.latency,
+        'jitter_ms': args.jitter,
+        'scenarios': [{k: v for k, v in s.items() if k != 'results'} for s in scenarios],
+        'results': results,
+    }
+    Path(args.output).write_text(json.dumps(report, indent=2, ensure_ascii=False))
+    print(f"\nResults written to {args.output}")
+    if args.baseline:
+        sys.exit(1 if compare(results, json.loads(Path(args.baseline).read_text()),
+                              args.tolerance, args.min_delta_ms) else 0)
+
+if __name__ == '__main__':
+    main()
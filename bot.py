@@ -20,13 +20,36 @@ Setup:
 """
 
 import os
+import re
+import json
+import pickle
+import time
+import asyncio
+import functools
 import logging
-from datetime import datetime, timedelta
+import itertools
+import multiprocessing
+import operator
+import contextvars
+import secrets
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
+from urllib.parse import urlparse, urlunparse
+from requests.adapters import HTTPAdapter
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import BadRequest
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler, ContextTypes, filters
 from instagrapi import Client
-from instagrapi.exceptions import LoginRequired, TwoFactorRequired
+from instagrapi.exceptions import (
+    ClientConnectionError, ClientError, ClientIncompleteReadError, ClientJSONDecodeError, ClientRequestTimeout,
+    ClientThrottledError, FeedbackRequired, LoginRequired, PleaseWaitFewMinutes, RateLimitError, TwoFactorRequired
+)
+from instagrapi.mixins.note import NoteAudience
+from instagrapi.extractors import extract_direct_message
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -67,6 +90,374 @@ if missing:
 
 print("✅ All required .env variables loaded successfully!")
 
+# ==================== Tuning ====================
+IG_WORKERS = int(os.getenv('IG_WORKERS', '8'))  # accounts running instagrapi calls at once (per shard)
+SHARDS = int(os.getenv('SHARDS', '0'))  # worker processes owning the Instagram clients; 0 keeps them in this process
+FANOUT_CONCURRENCY = int(os.getenv('FANOUT_CONCURRENCY', '4'))  # accounts queried at once by multi-account commands
+ACCOUNT_TIMEOUT = float(os.getenv('ACCOUNT_TIMEOUT', '90'))  # seconds before one account's lookup is given up
+PROGRESS_EDIT_INTERVAL = 1.0  # seconds between edits of a live progress message
+NOTES_CACHE_TTL = float(os.getenv('NOTES_CACHE_TTL', '60'))  # seconds a fetched notes tray is reused
+PENDING_TTL = float(os.getenv('PENDING_TTL', '600'))  # seconds an account keyboard stays usable
+PENDING_MAX = int(os.getenv('PENDING_MAX', '50'))  # open account keyboards kept; the oldest go first
+REPLY_WINDOW = timedelta(hours=24)
+INBOX_THREADS = 20  # most recent threads checked for replies
+INBOX_MESSAGES = 10  # latest messages per thread embedded in the inbox payload
+THREAD_HISTORY = 30  # messages fetched when a busy thread's inbox slice may hide older replies
+USER_CACHE_FILE = Path(os.getenv('USER_CACHE_FILE', 'user_cache.json'))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL_HOURS', '168')) * 3600
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '5000'))
+REPLY_CURSORS_FILE = Path(os.getenv('REPLY_CURSORS_FILE', 'reply_cursors.json'))
+OWN_NOTES_FILE = Path(os.getenv('OWN_NOTES_FILE', 'own_notes.json'))
+BOT_DB = Path(os.getenv('BOT_DB', 'bot.db'))  # SQLite database for scheduled and queued work
+SCHEDULE_TICK = float(os.getenv('SCHEDULE_TICK', '30'))  # seconds between checks for due scheduled notes
+WRITE_WAIT = float(os.getenv('WRITE_WAIT', '30'))  # seconds a command waits for its queued write before moving on
+WRITE_MAX_ATTEMPTS = int(os.getenv('WRITE_MAX_ATTEMPTS', '6'))  # tries before a write lands in the dead-letter list
+WRITE_BACKOFF = float(os.getenv('WRITE_BACKOFF', '30'))  # first retry delay in seconds, doubled per attempt
+WRITE_BACKOFF_MAX = float(os.getenv('WRITE_BACKOFF_MAX', '3600'))
+PIN_CHECK = float(os.getenv('PIN_CHECK', '300'))  # seconds between checks of pinned notes
+PIN_MARGIN = float(os.getenv('PIN_MARGIN', '1800'))  # re-post a pinned note this many seconds before it expires
+PIN_STAGGER = float(os.getenv('PIN_STAGGER', '15'))  # seconds between re-posts on different accounts
+SESSION_CHECK = os.getenv('SESSION_CHECK', 'light').strip().lower()  # full | light | none, see validate_session
+SESSION_TRUST_MINUTES = float(os.getenv('SESSION_TRUST_MINUTES', '360'))  # skip the check for recently verified sessions
+TWO_FACTOR_TTL = float(os.getenv('TWO_FACTOR_TTL', '600'))  # seconds a 2FA challenge waits for its code
+RELOGIN_COOLDOWN = float(os.getenv('RELOGIN_COOLDOWN', '300'))  # seconds a failed re-login is reused instead of retried
+IG_RATE = float(os.getenv('IG_RATE', '20'))  # sustained Instagram requests per minute, per account
+IG_BURST = int(os.getenv('IG_BURST', '5'))  # requests an account may make back to back after a quiet spell
+WARM_UP = os.getenv('WARM_UP', '1').strip().lower() in ('1', 'true', 'yes', 'on')  # log in to every account at startup
+REPLY_POLL = os.getenv('REPLY_POLL', '0').strip().lower() in ('1', 'true', 'yes', 'on')
+REPLY_POLL_MIN = float(os.getenv('REPLY_POLL_MIN', '120'))  # seconds between inbox polls right after activity
+REPLY_POLL_MAX = float(os.getenv('REPLY_POLL_MAX', '1800'))  # slowest poll interval for a quiet inbox
+BOT_MODE = os.getenv('BOT_MODE', 'polling').strip().lower()  # polling | webhook
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # public HTTPS URL Telegram posts updates to; its path is served locally
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '127.0.0.1')  # behind a reverse proxy; 0.0.0.0 to expose directly
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')  # sent back by Telegram in X-Telegram-Bot-Api-Secret-Token
+INSTAGRAM_API_URL = os.getenv('INSTAGRAM_API_URL', '').rstrip('/')  # e.g. http://127.0.0.1:8910 for fake_instagram.py
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))  # serve OpenMetrics at http://METRICS_LISTEN:METRICS_PORT/metrics; 0 = off
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_FILE = os.getenv('METRICS_FILE', '')  # also write them to this file
+METRICS_FILE_INTERVAL = float(os.getenv('METRICS_FILE_INTERVAL', '60'))  # seconds between file writes
+LOOP_LAG_INTERVAL = 0.5  # seconds between event-loop lag probes
+
+if IG_RATE <= 0 or IG_BURST < 1:
+    raise ValueError("IG_RATE must be above 0 and IG_BURST at least 1")
+if BOT_MODE not in ('polling', 'webhook'):
+    raise ValueError("BOT_MODE must be 'polling' or 'webhook'")
+if BOT_MODE == 'webhook' and not (WEBHOOK_URL and re.fullmatch(r'[A-Za-z0-9_-]{1,256}', WEBHOOK_SECRET)):
+    raise ValueError("BOT_MODE=webhook needs WEBHOOK_URL and WEBHOOK_SECRET (1-256 of A-Z, a-z, 0-9, _ and -)")
+
+# ==================== Metrics ====================
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+OPENMETRICS_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# name -> (type, help); counters are exposed with a _total suffix
+METRIC_INFO = {
+    'notes_bot_command_seconds': ('histogram', "Time spent handling a Telegram update, by handler."),
+    'notes_bot_instagram_requests': ('counter', "HTTP requests sent to Instagram, by account, endpoint and status."),
+    'notes_bot_instagram_request_seconds': ('histogram', "Instagram response time, by account and endpoint."),
+    'notes_bot_instagram_throttled': ('counter', "Responses that made the rate limiter slow an account down."),
+    'notes_bot_rate_limit_wait_seconds': ('histogram', "Time a request waited for the account's rate limiter."),
+    'notes_bot_logins': ('counter', "Session loads, logins, re-logins and 2FA completions, by result."),
+    'notes_bot_cache_lookups': ('counter', "Lookups in the notes tray and username caches, by result."),
+    'notes_bot_event_loop_lag_seconds': ('histogram', "How late the event loop ran a timer."),
+}
+
+class Metrics:
+    """Counters and histograms, rendered in the OpenMetrics text format.
+
+    Safe to update from executor threads. Shard processes record into their own
+    instance and send drain() with every call result; the bot merge()s it, so
+    its /metrics covers the Instagram traffic of all shards.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [count per bucket..., count above the last, sum]
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        slot = next((i for i, bound in enumerate(LATENCY_BUCKETS) if value <= bound), len(LATENCY_BUCKETS))
+        with self.lock:
+            histogram = self.histograms.setdefault(key, [0] * (len(LATENCY_BUCKETS) + 2))
+            histogram[slot] += 1
+            histogram[-1] += value
+
+    def drain(self):
+        """Everything recorded since the last drain, for merge() in another process."""
+        with self.lock:
+            snapshot = (self.counters, self.histograms)
+            self.counters, self.histograms = {}, {}
+        return snapshot
+
+    def merge(self, snapshot):
+        counters, histograms = snapshot
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, values in histograms.items():
+                mine = self.histograms.setdefault(key, [0] * len(values))
+                for i, value in enumerate(values):
+                    mine[i] += value
+
+    def render(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: list(values) for key, values in self.histograms.items()}
+        samples = {name: [] for name in METRIC_INFO}
+        for (name, labels), value in sorted(counters.items()):
+            samples[name].append(f"{name}_total{format_labels(labels)} {value}")
+        for (name, labels), values in sorted(histograms.items()):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), values):
+                cumulative += count
+                samples[name].append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+            samples[name].append(f"{name}_count{format_labels(labels)} {cumulative}")
+            samples[name].append(f"{name}_sum{format_labels(labels)} {values[-1]}")
+        lines = []
+        for name, (kind, help_text) in METRIC_INFO.items():
+            lines += [f"# TYPE {name} {kind}", f"# HELP {name} {help_text}", *samples[name]]
+        return "\n".join(lines + ["# EOF"]) + "\n"
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels) + "}"
+
+metrics = Metrics()
+
+def endpoint_label(url):
+    """'https://i.instagram.com/api/v1/users/123/info/?x=1' -> 'users/{id}/info/'."""
+    path = urlparse(url).path
+    path = path[len('/api/v1/'):] if path.startswith('/api/v1/') else path.lstrip('/')
+    return re.sub(r'(?<![^/])\d+(?=/|$)', '{id}', path)
+
+def timed(callback):
+    """Wrap a handler so its run time is recorded under its function name."""
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            metrics.observe('notes_bot_command_seconds', time.perf_counter() - started, command=callback.__name__)
+    return wrapper
+
+async def watch_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        metrics.observe('notes_bot_event_loop_lag_seconds', max(0.0, loop.time() - started - LOOP_LAG_INTERVAL))
+
+async def serve_metrics(reader, writer):
+    """Answer one HTTP request on the metrics port: GET /metrics, anything else is a 404."""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 10)
+        while await asyncio.wait_for(reader.readline(), 10) not in (b'\r\n', b'\n', b''):
+            pass  # headers
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, content_type, body = '200 OK', OPENMETRICS_TYPE, (await asyncio.to_thread(metrics.render)).encode()
+        else:
+            status, content_type, body = '404 Not Found', 'text/plain', b"Metrics are at /metrics\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                     f"Connection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+def write_metrics_file():
+    tmp = Path(METRICS_FILE).with_suffix('.tmp')
+    tmp.write_text(metrics.render())
+    tmp.replace(METRICS_FILE)
+
+async def dump_metrics():
+    while True:
+        await asyncio.sleep(METRICS_FILE_INTERVAL)
+        try:
+            await asyncio.to_thread(write_metrics_file)
+        except OSError as e:
+            logger.warning(f"Could not write {METRICS_FILE}: {e}")
+
+async def start_metrics(app):
+    if not (METRICS_PORT or METRICS_FILE):
+        return
+    app.bot_data['loop_lag'] = asyncio.create_task(watch_loop_lag())
+    if METRICS_PORT:
+        app.bot_data['metrics_server'] = await asyncio.start_server(serve_metrics, METRICS_LISTEN, METRICS_PORT)
+        logger.info(f"Serving metrics on http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+    if METRICS_FILE:
+        app.bot_data['metrics_dump'] = asyncio.create_task(dump_metrics())
+
+# ==================== Rate Limiting ====================
+# 'background' for jobs nobody is waiting on; they leave part of the burst to commands
+ig_priority = contextvars.ContextVar('ig_priority', default='interactive')
+
+# Every account has its own worker thread; IG_WORKERS slots bound how many of
+# them run instagrapi at once. A thread sleeping on its rate limiter hands its
+# slot back, so throttled or background-paced accounts don't hold up the rest.
+ig_slots = threading.Semaphore(IG_WORKERS)
+slot_state = threading.local()
+
+def sleep_without_slot(seconds):
+    """time.sleep that lets another account use this thread's slot meanwhile."""
+    if not getattr(slot_state, 'held', False):
+        time.sleep(seconds)
+        return
+    ig_slots.release()
+    try:
+        time.sleep(seconds)
+    finally:
+        ig_slots.acquire()
+
+class RateLimiter:
+    """Token bucket pacing one account's Instagram requests.
+
+    Holds up to `burst` tokens refilled at `rate` per second; every HTTP request
+    takes one, sleeping (without its slot) until it's available. Background requests only spend
+    tokens above half the burst (at most burst - 1 held back, so they can still
+    run with a burst of 1) and interactive commands always find some left.
+    Throttling responses (429, feedback_required, "please wait") halve the rate
+    down to 1/16 of the configured one; each clean response wins back a bit.
+    """
+
+    def __init__(self, rate, burst):
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, background=False):
+        """Block until a request may go out; returns the seconds waited."""
+        needed = 1 + (min(self.burst / 2, self.burst - 1) if background else 0)
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= needed:
+                    self.tokens -= 1
+                    return waited
+                delay = (needed - self.tokens) / self.rate
+            sleep_without_slot(delay)
+            waited += delay
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.base_rate / 16, self.rate / 2)
+            self.tokens = 0.0
+        logger.warning(f"Instagram is throttling, slowing down to {self.rate * 60:.1f} requests/min")
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.base_rate, self.rate + self.base_rate / 50)
+
+def is_throttled(response):
+    if response.status_code == 429:
+        return True
+    if response.status_code in (400, 403):
+        body = response.text
+        return 'feedback_required' in body or 'Please wait a few minutes' in body or 'rate_limit_error' in body
+    return False
+
+def limit_requests(cl, name):
+    """Route every HTTP request of the client through the account's limiter and record it in metrics.
+
+    One call of limited_send is one request on the wire, so counts and latencies
+    stay per request only while drop_fixed_delays() keeps the adapter from retrying.
+    """
+    limiter = accounts[name]['limiter']
+    send = cl.private.send
+
+    def limited_send(request, **kwargs):
+        waited = limiter.acquire(background=ig_priority.get() == 'background')
+        metrics.observe('notes_bot_rate_limit_wait_seconds', waited, account=name)
+        endpoint = endpoint_label(request.url)
+        started = time.perf_counter()
+        try:
+            response = send(request, **kwargs)
+        except Exception:
+            metrics.inc('notes_bot_instagram_requests', account=name, endpoint=endpoint, status='error')
+            raise
+        metrics.observe('notes_bot_instagram_request_seconds', time.perf_counter() - started,
+                        account=name, endpoint=endpoint)
+        metrics.inc('notes_bot_instagram_requests', account=name, endpoint=endpoint, status=str(response.status_code))
+        if is_throttled(response):
+            limiter.throttled()
+            metrics.inc('notes_bot_instagram_throttled', account=name)
+        elif response.ok:
+            limiter.succeeded()
+        return response
+
+    cl.private.send = limited_send
+
+class LocalBackendAdapter(HTTPAdapter):
+    """Sends every request to INSTAGRAM_API_URL, keeping its path and query."""
+
+    def send(self, request, **kwargs):
+        base = urlparse(INSTAGRAM_API_URL)
+        url = urlparse(request.url)
+        request.url = urlunparse((base.scheme, base.netloc, base.path + url.path, url.params, url.query, ''))
+        return super().send(request, **kwargs)
+
+class LocalBackendClient(Client):
+    """Client talking to a local stand-in for Instagram such as fake_instagram.py.
+
+    instagrapi remounts its adapters whenever the retry config is applied, so the
+    redirect is mounted in the same hooks. Logins use the legacy password flow;
+    the current one needs device attestation a local backend can't verify.
+    """
+
+    def _configure_private_session_retry(self, private_transport=None):
+        adapter = LocalBackendAdapter(max_retries=self._build_private_session_retry_strategy())
+        self.private.mount("https://", adapter)
+        self.private.mount("http://", adapter)
+        self.private_transport = self._private_adapter_transport = 'requests'
+
+    def _configure_public_session_retry(self):
+        adapter = LocalBackendAdapter(max_retries=self._build_public_session_retry_strategy())
+        self.public.mount("https://", adapter)
+        self.public.mount("http://", adapter)
+
+    def login(self, username=None, password=None, relogin=False, verification_code=""):
+        return self.login_legacy(username, password, relogin=relogin, verification_code=verification_code)
+
+def drop_fixed_delays(cl):
+    """Pacing is the RateLimiter's job, not a fixed sleep before every request.
+
+    That includes instagrapi's own HTTP retries: its adapter retries 429/5xx up
+    to three times with backoff below the rate limiter, holding the account's
+    slot while it sleeps and hiding the extra requests from the limiter and the
+    metrics. load_settings() restores request_timeout (login_once.py writes 1)
+    and the retry config from the session file, so this runs again after every
+    load.
+    """
+    cl.delay_range = None
+    cl.set_retry_config(request_timeout=0, session_retry_total=0)
+
+def new_client(name):
+    cl = LocalBackendClient() if INSTAGRAM_API_URL else Client()
+    drop_fixed_delays(cl)
+    limit_requests(cl, name)
+    return cl
+
 # ==================== Account Parsing ====================
 accounts = {}
 account_list = []
@@ -89,7 +480,15 @@ for part in INSTA_ACCOUNTS_STR.split('|'):
         'username': username,
         'password': password,
         'session_file': Path(f"session_{name}.json"),
-        'client': None
+        'client': None,
+        'lock': asyncio.Lock(),
+        'replies_lock': asyncio.Lock(),  # one reply-cursor update at a time
+        'status': 'cold',  # cold → ready | 2fa | failed
+        'generation': 0,  # bumped whenever the session is renewed
+        'relogin_lock': threading.Lock(),
+        'relogin_failure': None,  # (time, error) of the last failed re-login
+        'limiter': RateLimiter(IG_RATE / 60, IG_BURST),
+        'executor': ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'instagrapi-{name}'),
     }
     account_list.append(name)
     print(f"   Loaded account: {name} (@{username})")
@@ -101,43 +500,1375 @@ if not accounts:
 print(f"✅ Successfully loaded {len(accounts)} Instagram account(s)!\n")
 
 # ==================== State & Client ====================
-pending_action = {}
-waiting_for_2fa = None
+class PendingActions:
+    """Actions waiting for an account to be picked, keyed by the token in the keyboard's callback data.
+
+    Entries expire after `ttl` seconds and the oldest are dropped beyond
+    `max_size`. A token can be taken only once, so a double tap on a button
+    runs the action a single time.
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()  # token -> (action, stored_at), oldest first
+        self.lock = threading.Lock()
+
+    def _evict(self, now):
+        while self.entries and now - next(iter(self.entries.values()))[1] >= self.ttl:
+            self.entries.popitem(last=False)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def add(self, action):
+        token = secrets.token_hex(4)
+        now = time.time()
+        with self.lock:
+            self.entries[token] = (action, now)
+            self._evict(now)
+        return token
+
+    def take(self, token):
+        """The action for `token`, removing it; None if unknown, expired or already taken."""
+        with self.lock:
+            self._evict(time.time())
+            entry = self.entries.pop(token, None)
+        return entry[0] if entry else None
+
+pending_action = PendingActions(PENDING_TTL, PENDING_MAX)
+
+# Accounts whose login stopped at 2FA: name -> (client that started the login, opened at).
+# Finishing on the same client keeps the device identity Instagram sent the code for.
+two_factor = {}
+two_factor_lock = threading.Lock()  # get_client/relogin open challenges from account threads
+
+def open_2fa(name, cl):
+    with two_factor_lock:
+        two_factor[name] = (cl, time.time())
+    accounts[name]['status'] = '2fa'
+    logger.info(f"2FA required for {name}")
+
+def pending_2fa():
+    """Names with an open 2FA challenge; expired ones are dropped so the next use logs in afresh."""
+    if shard_pool:
+        # The challenges live in the shard processes; their status is mirrored here
+        return [name for name in account_list if accounts[name]['status'] == '2fa']
+    now = time.time()
+    with two_factor_lock:
+        for name, (_, opened) in list(two_factor.items()):
+            if now - opened >= TWO_FACTOR_TTL:
+                del two_factor[name]
+                accounts[name]['status'] = 'cold'
+                logger.info(f"2FA challenge for {name} expired")
+        return [name for name in account_list if name in two_factor]
+
+def validate_session(cl, session_file):
+    """Check a freshly loaded session, as cheaply as SESSION_CHECK allows.
+
+    "full" fetches the timeline feed, "light" asks for the own account only and
+    "none" trusts the file. A session verified within SESSION_TRUST_MINUTES (its
+    file mtime is bumped on every successful check) is trusted as well; if it
+    turns out to be stale, the first real call re-logs in via call_client.
+    """
+    age = time.time() - session_file.stat().st_mtime
+    if SESSION_CHECK == 'none' or age < SESSION_TRUST_MINUTES * 60:
+        return
+    if SESSION_CHECK == 'full':
+        cl.get_timeline_feed()
+    else:
+        cl.account_info()
+    session_file.touch()
 
 def get_client(name):
     data = accounts[name]
     if data['client']:
         return data['client']
-    
-    cl = Client()
-    cl.delay_range = [1, 5]
+    if name in pending_2fa():
+        return None  # logging in again would only send another code
+
+    cl = new_client(name)
     session_file = data['session_file']
 
     if session_file.exists():
         cl.load_settings(session_file)
+        drop_fixed_delays(cl)
         try:
-            cl.get_timeline_feed()
+            validate_session(cl, session_file)
             data['client'] = cl
+            data['status'] = 'ready'
+            metrics.inc('notes_bot_logins', account=name, kind='session', result='ok')
             logger.info(f"Session valid for {name}")
             return cl
         except LoginRequired:
+            metrics.inc('notes_bot_logins', account=name, kind='session', result='expired')
             logger.warning(f"Session expired for {name}")
 
     try:
         cl.login(data['username'], data['password'])
         cl.dump_settings(session_file)
         data['client'] = cl
+        data['status'] = 'ready'
+        metrics.inc('notes_bot_logins', account=name, kind='login', result='ok')
         logger.info(f"Logged in successfully: {name}")
         return cl
     except TwoFactorRequired:
-        global waiting_for_2fa
-        waiting_for_2fa = name
-        logger.info(f"2FA required for {name}")
+        metrics.inc('notes_bot_logins', account=name, kind='login', result='2fa')
+        open_2fa(name, cl)
         return None
     except Exception as e:
+        data['status'] = 'failed'
+        metrics.inc('notes_bot_logins', account=name, kind='login', result='failed')
         logger.error(f"Login failed for {name}: {e}")
         return None
 
+def complete_2fa(name, code):
+    data = accounts[name]
+    with two_factor_lock:
+        if name not in two_factor:
+            raise ClientError(f"{name} has no 2FA challenge waiting (it may have expired)")
+        cl = two_factor[name][0]
+    try:
+        cl.login(data['username'], data['password'], verification_code=code)
+    except Exception:
+        metrics.inc('notes_bot_logins', account=name, kind='2fa', result='failed')
+        raise
+    metrics.inc('notes_bot_logins', account=name, kind='2fa', result='ok')
+    with two_factor_lock:
+        two_factor.pop(name, None)
+    cl.dump_settings(data['session_file'])
+    data['client'] = cl
+    data['status'] = 'ready'
+    data['generation'] += 1
+    data['relogin_failure'] = None
+    return cl
+
+def relogin(name, seen_generation):
+    """Log the account's client in again after LoginRequired, once for all callers.
+
+    Callers that hit LoginRequired together queue on the account's relogin lock;
+    the first one logs in and bumps the session generation, the rest see the new
+    generation and just retry. A failed login is remembered for RELOGIN_COOLDOWN
+    and handed to later callers instead of hammering Instagram with new attempts.
+    """
+    data = accounts[name]
+    with data['relogin_lock']:
+        if data['generation'] != seen_generation:
+            return
+        failure = data['relogin_failure']
+        if failure and time.time() - failure[0] < RELOGIN_COOLDOWN:
+            raise failure[1]
+        logger.warning(f"Session expired for {name}, logging in again")
+        cl = data['client']
+        # instagrapi refuses relogin=True after two failures until a login succeeds;
+        # RELOGIN_COOLDOWN already paces the retries
+        cl.relogin_attempt = 0
+        try:
+            cl.login(data['username'], data['password'], relogin=True)
+        except Exception as e:
+            data['relogin_failure'] = (time.time(), e)
+            if isinstance(e, TwoFactorRequired):
+                metrics.inc('notes_bot_logins', account=name, kind='relogin', result='2fa')
+                open_2fa(name, cl)
+            else:
+                metrics.inc('notes_bot_logins', account=name, kind='relogin', result='failed')
+                data['status'] = 'failed'
+            logger.error(f"Re-login failed for {name}: {e}")
+            raise
+        cl.dump_settings(data['session_file'])
+        metrics.inc('notes_bot_logins', account=name, kind='relogin', result='ok')
+        data['relogin_failure'] = None
+        data['generation'] += 1
+        data['status'] = 'ready'
+        logger.info(f"Logged in again: {name}")
+
+def call_client(name, func, *args, **kwargs):
+    """Run func(client, *args, **kwargs) on the account's current client.
+
+    On LoginRequired the session is renewed through relogin() and the call is
+    retried once on the (possibly replaced) client.
+    """
+    data = accounts[name]
+    generation = data['generation']
+    try:
+        return func(data['client'], *args, **kwargs)
+    except LoginRequired:
+        relogin(name, generation)
+        return func(data['client'], *args, **kwargs)
+
+# ==================== Async Client ====================
+# instagrapi is blocking (and waits on the account's RateLimiter before every
+# request), so every call is shipped to the account's own thread, holding one
+# of the IG_WORKERS slots while it runs. Calls for the same account are
+# serialized by the account lock; different accounts run side by side.
+def run_in_slot(func, *args, **kwargs):
+    ig_slots.acquire()
+    slot_state.held = True
+    try:
+        return func(*args, **kwargs)
+    finally:
+        slot_state.held = False
+        ig_slots.release()
+
+async def run_blocking(name, func, *args, **kwargs):
+    """Run func(*args, **kwargs) for account `name`, in its shard process when SHARDS is set."""
+    if shard_pool:
+        return await shard_pool.call(name, func, *args, **kwargs)
+    return await run_on_account(name, func, *args, **kwargs)
+
+async def run_on_account(name, func, *args, **kwargs):
+    lock = accounts[name]['lock']
+    await lock.acquire()
+    try:
+        # Carry context variables such as ig_priority over to the worker thread
+        context = contextvars.copy_context()
+        future = asyncio.get_running_loop().run_in_executor(
+            accounts[name]['executor'], functools.partial(context.run, run_in_slot, func, *args, **kwargs))
+    except BaseException:
+        lock.release()
+        raise
+
+    def release(fut):
+        # The thread can't be interrupted, so the account stays locked until it
+        # really finishes, even if the awaiting handler was cancelled meanwhile.
+        lock.release()
+        if not fut.cancelled():
+            fut.exception()
+
+    future.add_done_callback(release)
+    return await asyncio.shield(future)
+
+class AsyncClient:
+    """Awaitable view of an instagrapi Client: `await cl.get_notes()` runs in the account's thread.
+
+    The Client itself may live in a shard process, so plain attributes are
+    limited to the ones open_client() copies over.
+    """
+
+    def __init__(self, name, info):
+        self.name = name
+        self.info = info
+
+    def __getattr__(self, attr):
+        if attr in self.info:
+            return self.info[attr]
+
+        async def call(*args, **kwargs):
+            return await run_blocking(self.name, call_client, self.name, operator.methodcaller(attr, *args, **kwargs))
+        return call
+
+    async def run(self, func, *args, **kwargs):
+        """Run func(client, *args, **kwargs) with exclusive use of the account."""
+        return await run_blocking(self.name, call_client, self.name, func, *args, **kwargs)
+
+def open_client(name):
+    """Log the account in if needed; returns the client attributes AsyncClient exposes, or None."""
+    cl = get_client(name)
+    return {'user_id': cl.user_id} if cl else None
+
+async def aget_client(name):
+    info = await run_blocking(name, open_client, name)
+    return AsyncClient(name, info) if info else None
+
+async def fan_out(names, func, on_result=None):
+    """Await func(name) for every account, FANOUT_CONCURRENCY at a time.
+
+    Results come back in the order of `names`; a failure or timeout is returned
+    in place of its account's result instead of aborting the others. If given,
+    `await on_result(name, result)` runs as soon as each account is done.
+    """
+    semaphore = asyncio.Semaphore(FANOUT_CONCURRENCY)
+
+    async def one(name):
+        async with semaphore:
+            try:
+                result = await asyncio.wait_for(func(name), ACCOUNT_TIMEOUT)
+            except Exception as e:
+                result = e
+        if on_result:
+            await on_result(name, result)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    return await asyncio.gather(*(one(name) for name in names), return_exceptions=True)
+
+def describe_failure(error):
+    if isinstance(error, asyncio.TimeoutError):
+        return f"Timed out after {ACCOUNT_TIMEOUT:g}s"
+    return f"Error - {error}"
+
+def describe_outcome(result):
+    """Status line for a multi-account action that returned `result` or failed with it."""
+    if isinstance(result, WriteQueued):
+        return f"⏳ {result}"
+    if isinstance(result, Exception):
+        return f"❌ {describe_failure(result)}"
+    return result
+
+# ==================== Shards ====================
+# With SHARDS=N the accounts are split over N spawned worker processes, each with
+# its own Clients, locks, rate limiters and account threads, so instagrapi's JSON and
+# model parsing for many accounts isn't confined to one GIL. run_blocking()
+# pickles (func, args) over a pipe to the owning shard, which runs it with
+# run_on_account() and sends back the result, the account's status and the
+# metrics recorded since its last reply.
+# Everything else (commands, caches, the write queue) stays in this process.
+
+class ShardError(ClientError):
+    """A shard process died, or its error couldn't be sent back as is."""
+
+def portable_error(e):
+    """`e` if it survives pickling, else the same type with just the message, else a ShardError."""
+    try:
+        pickle.loads(pickle.dumps(e))
+        return e
+    except Exception:
+        pass
+    try:
+        error = type(e)(str(e))
+        pickle.loads(pickle.dumps(error))
+        return error
+    except Exception:
+        return ShardError(f"{type(e).__name__}: {e}")
+
+def shard_main(index, conn):
+    """Entry point of a shard process: serve run_blocking() calls from the bot until the pipe closes."""
+    user_cache.path = USER_CACHE_FILE.with_suffix(f'.shard{index}.json')
+    user_cache.entries.clear()
+    user_cache.load()
+    asyncio.run(serve_shard(conn))
+
+async def serve_shard(conn):
+    loop = asyncio.get_running_loop()
+    tasks = set()
+
+    async def handle(call_id, name, func, args, kwargs, priority):
+        ig_priority.set(priority)
+        try:
+            reply = (call_id, True, await run_on_account(name, func, *args, **kwargs))
+        except Exception as e:
+            reply = (call_id, False, portable_error(e))
+        extra = (accounts[name]['status'], metrics.drain())
+        try:
+            payload = pickle.dumps(reply + extra)
+        except Exception as e:
+            payload = pickle.dumps((call_id, False, portable_error(e)) + extra)
+        conn.send_bytes(payload)
+        user_cache.save()
+
+    while True:
+        try:
+            request = pickle.loads(await loop.run_in_executor(None, conn.recv_bytes))
+        except EOFError:
+            return  # the bot exited
+        task = asyncio.create_task(handle(*request))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+class ShardPool:
+    def __init__(self, count):
+        self.count = count
+        self.context = multiprocessing.get_context('spawn')
+        self.shard_of = {name: i % count for i, name in enumerate(account_list)}
+        self.processes = [None] * count
+        self.conns = [None] * count
+        self.closing = False
+        self.calls = {}  # call id -> (shard, future)
+        self.ids = itertools.count()
+        self.loop = asyncio.get_running_loop()
+        for index in range(count):
+            self.start(index)
+
+    def start(self, index):
+        conn, child = self.context.Pipe()
+        process = self.context.Process(target=shard_main, args=(index, child), name=f'shard-{index}', daemon=True)
+        process.start()
+        child.close()
+        self.processes[index], self.conns[index] = process, conn
+        threading.Thread(target=self.read, args=(index, conn), name=f'shard-{index}-reader', daemon=True).start()
+        logger.info(f"Started shard {index} (pid {process.pid}) for "
+                    f"{sum(shard == index for shard in self.shard_of.values())} account(s)")
+
+    def read(self, index, conn):
+        while True:
+            try:
+                call_id, ok, value, status, recorded = pickle.loads(conn.recv_bytes())
+            except (EOFError, OSError):
+                break
+            metrics.merge(recorded)
+            self.loop.call_soon_threadsafe(self.resolve, call_id, ok, value, status)
+        if not self.closing:
+            self.loop.call_soon_threadsafe(self.lost, index, conn)
+
+    def resolve(self, call_id, ok, value, status):
+        shard, future, name = self.calls.pop(call_id, (None, None, None))
+        if future is None:
+            return
+        accounts[name]['status'] = status
+        if future.done():
+            return
+        if ok:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+    def lost(self, index, conn):
+        if self.closing or self.conns[index] is not conn:
+            return
+        logger.error(f"Shard {index} exited (code {self.processes[index].exitcode}), restarting it")
+        for call_id, (shard, future, name) in list(self.calls.items()):
+            if shard == index:
+                del self.calls[call_id]
+                if not future.done():
+                    future.set_exception(ShardError(f"shard {index} exited while running a call for {name}"))
+        for name, shard in self.shard_of.items():
+            if shard == index:
+                accounts[name]['status'] = 'cold'
+        self.start(index)
+
+    async def call(self, name, func, *args, **kwargs):
+        index = self.shard_of[name]
+        call_id = next(self.ids)
+        future = self.loop.create_future()
+        self.calls[call_id] = (index, future, name)
+        payload = pickle.dumps((call_id, name, func, args, kwargs, ig_priority.get()))
+        self.conns[index].send_bytes(payload)
+        return await future
+
+    def close(self):
+        self.closing = True
+        for conn, process in zip(self.conns, self.processes):
+            conn.close()
+            process.join(timeout=5)
+
+shard_pool = None
+
+def start_shards():
+    global shard_pool
+    if SHARDS > 0 and shard_pool is None:
+        shard_pool = ShardPool(min(SHARDS, len(account_list)))
+
+def stop_shards():
+    if shard_pool:
+        shard_pool.close()
+
+# ==================== Local State ====================
+def read_json(path, default):
+    if not path.exists():
+        return default
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable {path}: {e}")
+        return default
+
+def write_json(path, data):
+    tmp = path.with_suffix('.tmp')
+    tmp.write_text(json.dumps(data))
+    tmp.replace(path)
+
+class UserCache:
+    """user_id → username map shared by all accounts and persisted between restarts.
+
+    Filled from profiles Instagram already sends along (thread participants,
+    note authors) so senders resolve without extra profile requests. Entries
+    expire after `ttl` seconds and the least recently used ones are dropped
+    beyond `max_size`.
+    """
+
+    def __init__(self, path, ttl, max_size):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()  # user_id -> (username, stored_at)
+        self.lock = threading.Lock()  # touched from account threads
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        now = time.time()
+        data = read_json(self.path, {})
+        for user_id, (username, stored_at) in sorted(data.items(), key=lambda item: item[1][1]):
+            if now - stored_at < self.ttl:
+                self.entries[user_id] = (username, stored_at)
+        self._trim()
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            data = dict(self.entries)
+            self.dirty = False
+        write_json(self.path, data)
+
+    def get(self, user_id):
+        user_id = str(user_id)
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if not entry:
+                return None
+            if time.time() - entry[1] >= self.ttl:
+                del self.entries[user_id]
+                self.dirty = True
+                return None
+            self.entries.move_to_end(user_id)
+            return entry[0]
+
+    def add(self, user_id, username):
+        if not username:
+            return
+        with self.lock:
+            self.entries[str(user_id)] = (username, time.time())
+            self.entries.move_to_end(str(user_id))
+            self.dirty = True
+            self._trim()
+
+    def add_users(self, users):
+        for user in users:
+            if user is not None:
+                self.add(user.pk, user.username)
+
+    def _trim(self):
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+user_cache = UserCache(USER_CACHE_FILE, USER_CACHE_TTL, USER_CACHE_SIZE)
+
+def resolve_username(cl, user_id):
+    username = user_cache.get(user_id)
+    metrics.inc('notes_bot_cache_lookups', cache='users', result='hit' if username else 'miss')
+    if username:
+        return username
+    try:
+        username = cl.user_info(str(user_id)).username
+    except Exception as e:
+        logger.warning(f"Could not resolve user {user_id}: {e}")
+        return f"user_{user_id}"
+    user_cache.add(user_id, username)
+    return username
+
+class JsonStore:
+    """Small dict persisted as one JSON file, safe to use from executor threads."""
+
+    def __init__(self, path):
+        self.path = path
+        self.data = read_json(path, {})
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.data
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.data.get(key, default)
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+
+    def pop(self, key):
+        with self.lock:
+            return self.data.pop(key, None)
+
+    def save(self):
+        with self.lock:
+            data = dict(self.data)
+        write_json(self.path, data)
+
+# Per-account, per-thread reply state persisted between /note_replies runs:
+# {account: {thread_id: {'activity': last activity timestamp,
+#                        'last': [timestamp, item id] of the newest message seen,
+#                        'replies': [[timestamp, sender, text], ...] inside REPLY_WINDOW]}}
+reply_cursors = JsonStore(REPLY_CURSORS_FILE)
+
+# The note each account last posted through the bot:
+# {account: {'id': note id, 'text': ..., 'audience': 0 | 1, 'expires_at': timestamp}}
+own_notes = JsonStore(OWN_NOTES_FILE)
+
+# ==================== Replies ====================
+def message_key(msg):
+    # Timestamps only have second resolution; item ids keep increasing within a second
+    return (msg.timestamp.timestamp(), int(msg.id) if str(msg.id).isdigit() else 0)
+
+def thread_messages_since(cl, thread_id, last):
+    """Page a thread's history newest-first, stopping once the cursor `last` is reached."""
+    params = {"visual_message_return_type": "unseen", "direction": "older", "limit": "20"}
+    messages = []
+    while len(messages) < THREAD_HISTORY:
+        thread = cl.private_request(f"direct_v2/threads/{thread_id}/", params=params)["thread"]
+        page = [extract_direct_message(dict(item, thread_id=thread_id)) for item in thread["items"]]
+        messages.extend(page)
+        if not page or not thread.get("oldest_cursor") or min(map(message_key, page)) <= last:
+            break
+        params["cursor"] = thread["oldest_cursor"]
+    return messages
+
+def fetch_new_replies(cl, state):
+    """Bring one account's reply state (see ReplyCursors) up to date.
+
+    Returns (state, recent, new): the updated state, every reply inside
+    REPLY_WINDOW and the replies first seen by this call, oldest first.
+
+    The inbox listing is the only request for most threads: it carries each
+    thread's participants, last activity and latest messages. Threads whose
+    last activity matches their cursor are skipped outright, and the cursors
+    of threads outside the listing are kept until they leave REPLY_WINDOW. History is paged
+    only for threads whose whole inbox slice is newer than the cursor, and only
+    back to the cursor. Senders are looked up in user_cache, which the
+    participant lists keep warm.
+    """
+    since = (datetime.now() - REPLY_WINDOW).timestamp()
+    own_id = str(cl.user_id)
+    updated = {}
+    new = []
+    for thread in cl.direct_threads(amount=INBOX_THREADS, thread_message_limit=INBOX_MESSAGES):
+        activity = thread.last_activity_at.timestamp()
+        if activity < since:
+            continue
+        cursor = state.get(thread.id)
+        if cursor and cursor['activity'] == activity:
+            updated[thread.id] = cursor
+            continue
+        last = tuple(cursor['last']) if cursor else (since, 0)
+        messages = thread.messages
+        if len(messages) >= INBOX_MESSAGES and min(map(message_key, messages)) > last:
+            messages = thread_messages_since(cl, thread.id, last)
+        user_cache.add_users([*thread.users, *thread.left_users, thread.inviter])
+        fresh = sorted((m for m in messages if message_key(m) > last), key=message_key)
+        replies = [r for r in cursor['replies'] if r[0] >= since] if cursor else []
+        for msg in fresh:
+            if str(msg.user_id) == own_id:
+                continue
+            reply = [msg.timestamp.timestamp(), resolve_username(cl, msg.user_id), msg.text or "[media/emoji/reel]"]
+            replies.append(reply)
+            new.append(reply)
+        if fresh:
+            last = message_key(fresh[-1])
+        updated[thread.id] = {'activity': activity, 'last': list(last), 'replies': replies}
+    # Threads pushed out of the listing keep their cursor, or a later reply would
+    # bring back everything they already reported
+    for thread_id, cursor in state.items():
+        if thread_id not in updated and cursor['activity'] >= since:
+            updated[thread_id] = dict(cursor, replies=[r for r in cursor['replies'] if r[0] >= since])
+    recent = sorted((r for cursor in updated.values() for r in cursor['replies'] if r[0] >= since), key=lambda r: r[0])
+    new.sort(key=lambda r: r[0])
+    return updated, recent, new
+
+async def update_replies(cl):
+    """Run fetch_new_replies against the account's reply_cursors; returns (recent, new).
+
+    The account's replies lock keeps a background poll and /note_replies from
+    starting from the same cursors and both reporting the same replies.
+    """
+    async with accounts[cl.name]['replies_lock']:
+        state, recent, new = await cl.run(fetch_new_replies, reply_cursors.get(cl.name, {}))
+        reply_cursors.set(cl.name, state)
+    return recent, new
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime('%H:%M')
+
+# ==================== Database ====================
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS schedules (
+    id INTEGER PRIMARY KEY,
+    run_at REAL NOT NULL,      -- next due time, unix seconds
+    every REAL,                -- repeat interval in seconds, NULL for a one-off
+    accounts TEXT NOT NULL,    -- JSON list of account names
+    text TEXT NOT NULL,
+    audience INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS write_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,  -- never reused, so job numbers in old messages stay unambiguous
+    account TEXT NOT NULL,
+    op TEXT NOT NULL,          -- key of WRITE_OPS
+    payload TEXT NOT NULL,     -- JSON keyword arguments for the op
+    background INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'pending',  -- pending | dead
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_run REAL NOT NULL,
+    last_error TEXT,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS write_jobs_account ON write_jobs (account, status, id);
+CREATE TABLE IF NOT EXISTS pins (
+    account TEXT PRIMARY KEY,  -- keep this account's note up with...
+    text TEXT NOT NULL,
+    audience INTEGER NOT NULL
+);
+"""
+db = None
+db_lock = threading.Lock()
+
+def init_db():
+    global db
+    if db is None:
+        db = sqlite3.connect(BOT_DB, check_same_thread=False, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        db.executescript(SCHEMA)
+
+def db_query(sql, params=()):
+    with db_lock:
+        return db.execute(sql, params).fetchall()
+
+def db_execute(sql, params=()):
+    with db_lock:
+        return db.execute(sql, params)
+
+# ==================== Notes ====================
+# Per-account notes tray: {'fetched_at': monotonic time, 'by_user': {user pk: Note}, 'mine': Note or None}.
+# Notes posted or deleted through the bot are written through, so the next
+# lookup needn't fetch the tray again.
+notes_cache = {}
+
+def is_active(note):
+    return note is not None and note.expires_at > datetime.now(timezone.utc)
+
+def cache_tray(name, by_user, mine):
+    notes_cache[name] = {'fetched_at': time.monotonic(), 'by_user': by_user, 'mine': mine}
+
+def remember_own_note(name, note):
+    if note:
+        own_notes.set(name, {'id': note.id, 'text': note.text, 'audience': note.audience,
+                             'expires_at': note.expires_at.timestamp()})
+    else:
+        own_notes.pop(name)
+    own_notes.save()
+
+async def get_own_note(cl):
+    """The account's active note, from a tray fetched at most NOTES_CACHE_TTL ago."""
+    entry = notes_cache.get(cl.name)
+    if entry and time.monotonic() - entry['fetched_at'] < NOTES_CACHE_TTL:
+        metrics.inc('notes_bot_cache_lookups', cache='notes', result='hit')
+        return entry['mine'] if is_active(entry['mine']) else None
+    metrics.inc('notes_bot_cache_lookups', cache='notes', result='miss')
+    notes = await cl.get_notes()
+    user_cache.add_users(n.user for n in notes)
+    by_user = {str(n.user.pk): n for n in notes}
+    mine = by_user.get(str(cl.user_id))
+    cache_tray(cl.name, by_user, mine)
+    # The tray is the truth: it also catches notes posted or removed in the app
+    if (mine.id if mine else None) != own_notes.get(cl.name, {}).get('id'):
+        remember_own_note(cl.name, mine)
+    return mine
+
+async def post_note(cl, text, audience):
+    note = await cl.create_note(text, audience=NoteAudience(audience))
+    entry = notes_cache.get(cl.name)
+    by_user = entry['by_user'] if entry else {}
+    by_user[str(cl.user_id)] = note
+    cache_tray(cl.name, by_user, note)
+    remember_own_note(cl.name, note)
+    return note
+
+async def delete_own_note(cl):
+    """Delete the account's active note; returns False if there was none.
+
+    The id recorded when the note was posted is tried first, which makes the
+    common case a single request. Only when it's missing, expired or rejected
+    does this fall back to looking the note up in the tray.
+    """
+    stored = own_notes.get(cl.name)
+    if stored and stored['expires_at'] > time.time():
+        try:
+            deleted = await cl.delete_note(stored['id'])
+        except ClientError as e:
+            logger.info(f"Stored note of {cl.name} was rejected ({e}), checking the tray")
+            deleted = False
+        if not deleted:
+            notes_cache.pop(cl.name, None)
+    else:
+        deleted = False
+    if not deleted:
+        active = await get_own_note(cl)
+        if not active:
+            return False
+        await cl.delete_note(active.id)
+    entry = notes_cache.get(cl.name)
+    if entry:
+        entry['by_user'].pop(str(cl.user_id), None)
+        entry['mine'] = None
+    remember_own_note(cl.name, None)
+    # A deleted note shouldn't be brought back by its pin
+    db_execute("DELETE FROM pins WHERE account = ?", (cl.name,))
+    return True
+
+# ==================== Write Queue ====================
+# Every Instagram write (posting, deleting notes) is a row in write_jobs, run by
+# one worker task per account in insertion order. Transient failures are
+# retried with exponential backoff; anything else, or running out of attempts,
+# parks the job as 'dead' for /dead_letters. Jobs survive restarts.
+
+class AccountUnavailable(Exception):
+    pass
+
+class WriteQueued(Exception):
+    """The write didn't finish within WRITE_WAIT; it stays queued and is reported when done."""
+
+    def __init__(self, job_id, last_error=None):
+        self.job_id = job_id
+        detail = f" (last error: {last_error})" if last_error else ""
+        super().__init__(f"queued as job #{job_id}, retrying in the background{detail}")
+
+TRANSIENT_ERRORS = (
+    AccountUnavailable, asyncio.TimeoutError, ClientConnectionError, ClientIncompleteReadError,
+    ClientJSONDecodeError, ClientRequestTimeout, ClientThrottledError, FeedbackRequired, PleaseWaitFewMinutes,
+    RateLimitError,
+)
+
+WRITE_OPS = {'post': post_note, 'pin': post_note, 'delete': delete_own_note}
+WRITE_LABELS = {'post': "post note", 'pin': "post pinned note", 'delete': "delete note"}
+
+write_waiters = {}  # job id -> future of a command still waiting for the outcome
+write_wakeups = {}  # account -> Event set when its queue has new work
+write_workers = {}  # account -> worker Task
+write_bot = None  # set at startup; reports outcomes nobody is waiting for
+
+def ensure_write_worker(name):
+    if name not in write_wakeups:
+        write_wakeups[name] = asyncio.Event()
+    worker = write_workers.get(name)
+    if worker is None or worker.done():
+        write_workers[name] = asyncio.create_task(write_worker(name))
+    write_wakeups[name].set()
+
+async def enqueue_write(name, op, **payload):
+    """Queue an Instagram write for `name`; returns (job id, future of its result)."""
+    if op == 'post':
+        # Any other note replaces the pinned one, or its next refresh would overwrite it.
+        # Done here rather than when the post runs, so a /pin_note sent right after
+        # a still-queued /note keeps its pin.
+        db_execute("DELETE FROM pins WHERE account = ?", (name,))
+    job_id = db_execute(
+        "INSERT INTO write_jobs (account, op, payload, background, next_run, created) VALUES (?, ?, ?, ?, ?, ?)",
+        (name, op, json.dumps(payload), ig_priority.get() == 'background', time.time(), time.time())).lastrowid
+    future = asyncio.get_running_loop().create_future()
+    write_waiters[job_id] = future
+    ensure_write_worker(name)
+    return job_id, future
+
+async def queued_write(name, op, **payload):
+    """Queue a write and wait up to WRITE_WAIT for it; raises WriteQueued if it's still going."""
+    job_id, future = await enqueue_write(name, op, **payload)
+    try:
+        return await asyncio.wait_for(asyncio.shield(future), WRITE_WAIT)
+    except asyncio.TimeoutError:
+        write_waiters.pop(job_id, None)
+        rows = db_query("SELECT last_error FROM write_jobs WHERE id = ?", (job_id,))
+        raise WriteQueued(job_id, rows[0]['last_error'] if rows else None)
+
+async def run_write(job):
+    cl = await aget_client(job['account'])
+    if not cl:
+        raise AccountUnavailable(f"{job['account']} is not logged in")
+    return await WRITE_OPS[job['op']](cl, **json.loads(job['payload']))
+
+async def report_write(job, outcome):
+    future = write_waiters.pop(job['id'], None)
+    if future and not future.done():
+        if isinstance(outcome, Exception):
+            future.set_exception(outcome)
+        else:
+            future.set_result(outcome)
+        return
+    # Nobody is waiting any more (the command gave up or the bot restarted)
+    label = f"{WRITE_LABELS[job['op']]} on {job['account']} (job #{job['id']})"
+    if isinstance(outcome, Exception):
+        text = f"❌ Gave up on {label}: {outcome}\nSee /dead_letters."
+    else:
+        text = f"✅ Done: {label}"
+    if write_bot:
+        try:
+            await write_bot.send_message(ALLOWED_USER_ID, text)
+        except Exception as e:
+            logger.warning(f"Could not report write job #{job['id']}: {e}")
+
+async def write_worker(name):
+    wakeup = write_wakeups[name]
+    while True:
+        wakeup.clear()
+        rows = db_query("SELECT * FROM write_jobs WHERE account = ? AND status = 'pending' ORDER BY id LIMIT 1",
+                        (name,))
+        if not rows:
+            await wakeup.wait()
+            continue
+        job = rows[0]
+        delay = job['next_run'] - time.time()
+        if delay > 0:
+            try:
+                await asyncio.wait_for(wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        ig_priority.set('background' if job['background'] else 'interactive')
+        try:
+            result = await asyncio.wait_for(run_write(job), ACCOUNT_TIMEOUT)
+        except Exception as e:
+            attempts = job['attempts'] + 1
+            if isinstance(e, TRANSIENT_ERRORS) and attempts < WRITE_MAX_ATTEMPTS:
+                backoff = min(WRITE_BACKOFF_MAX, WRITE_BACKOFF * 2 ** (attempts - 1))
+                logger.warning(f"Write job #{job['id']} for {name} failed ({e!r}), retry {attempts} in {backoff:g}s")
+                db_execute("UPDATE write_jobs SET attempts = ?, next_run = ?, last_error = ? WHERE id = ?",
+                           (attempts, time.time() + backoff, str(e) or repr(e), job['id']))
+                continue
+            logger.error(f"Write job #{job['id']} for {name} is dead after {attempts} attempt(s): {e!r}")
+            db_execute("UPDATE write_jobs SET status = 'dead', attempts = ?, last_error = ? WHERE id = ?",
+                       (attempts, str(e) or repr(e), job['id']))
+            await report_write(job, e)
+            continue
+        db_execute("DELETE FROM write_jobs WHERE id = ?", (job['id'],))
+        await report_write(job, result)
+
+def start_write_workers(bot):
+    """Resume the queues left over from the last run."""
+    global write_bot
+    write_bot = bot
+    for row in db_query("SELECT DISTINCT account FROM write_jobs WHERE status = 'pending'"):
+        if row['account'] in accounts:
+            ensure_write_worker(row['account'])
+
+async def dead_letters(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ALLOWED_USER_ID:
+        return
+    rows = db_query("SELECT * FROM write_jobs WHERE status = 'dead' ORDER BY id")
+    if not rows:
+        await update.message.reply_text("No failed writes. 🎉")
+        return
+    lines = ["💀 Failed writes:"]
+    for row in rows:
+        when = datetime.fromtimestamp(row['created']).strftime('%m-%d %H:%M')
+        lines.append(f"#{row['id']} {when} {WRITE_LABELS[row['op']]} on {row['account']} {row['payload']}\n"
+                     f"    {row['attempts']} attempt(s), last error: {row['last_error']}")
+    lines.append("\n/retry_dead <id|all> to queue again, /drop_dead <id|all> to discard")
+    await update.message.reply_text("\n".join(lines))
+
+def dead_job_ids(args):
+    if [arg.lower() for arg in args] == ['all']:
+        return [row['id'] for row in db_query("SELECT id FROM write_jobs WHERE status = 'dead'")]
+    ids = [arg.lstrip('#') for arg in args]
+    return [int(i) for i in ids] if ids and all(i.isdigit() for i in ids) else None
+
+async def retry_dead(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ALLOWED_USER_ID:
+        return
+    ids = dead_job_ids(context.args)
+    if ids is None:
+        await update.message.reply_text("Usage: /retry_dead <id|all> (see /dead_letters)")
+        return
+    retried = 0
+    for job_id in ids:
+        rows = db_query("SELECT account FROM write_jobs WHERE id = ? AND status = 'dead'", (job_id,))
+        if rows and rows[0]['account'] in accounts:
+            db_execute("UPDATE write_jobs SET status = 'pending', attempts = 0, next_run = ? WHERE id = ?",
+                       (time.time(), job_id))
+            ensure_write_worker(rows[0]['account'])
+            retried += 1
+    await update.message.reply_text(f"Queued {retried} write(s) again. You'll get a message when each is done.")
+
+async def drop_dead(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ALLOWED_USER_ID:
+        return
+    ids = dead_job_ids(context.args)
+    if ids is None:
+        await update.message.reply_text("Usage: /drop_dead <id|all> (see /dead_letters)")
+        return
+    dropped = sum(db_execute("DELETE FROM write_jobs WHERE id = ? AND status = 'dead'", (job_id,)).rowcount
+                  for job_id in ids)
+    await update.message.reply_text(f"Discarded {dropped} failed write(s).")
+
+# ==================== Multi-Account Commands ====================
+def parse_selector(spec):
+    """Accounts picked by a selector like "all", "1,3,5", "2-4" or "personal,work".
+
+    Returns the names in account_list order, or None if any part doesn't match.
+    """
+    if spec.lower() == 'all':
+        return list(account_list)
+    chosen = set()
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue  # "1, 3" arrives as the arguments "1," and "3"
+        span = re.fullmatch(r'(\d+)-(\d+)', part)
+        if part in accounts:
+            chosen.add(part)
+        elif part.isdigit() and 1 <= int(part) <= len(account_list):
+            chosen.add(account_list[int(part) - 1])
+        elif span and 1 <= int(span[1]) <= int(span[2]) <= len(account_list):
+            chosen.update(account_list[int(span[1]) - 1:int(span[2])])
+        else:
+            return None
+    return [name for name in account_list if name in chosen]
+
+async def run_with_progress(message, title, names, action):
+    """Run `await action(name)` for the accounts concurrently, live in one message.
+
+    The reply lists every account and is edited as each one finishes; action
+    returns that account's status line. Edits are spaced PROGRESS_EDIT_INTERVAL
+    apart to stay clear of Telegram's flood limits, with a final edit at the end.
+    """
+    status = {name: "⏳" for name in names}
+    edit_lock = asyncio.Lock()
+    last_edit = time.monotonic()
+
+    def render():
+        lines = [title]
+        lines += [f"{account_list.index(name) + 1}. {name} (@{accounts[name]['username']}): {status[name]}"
+                  for name in names]
+        return "\n".join(lines)
+
+    async def refresh(final=False):
+        nonlocal last_edit
+        async with edit_lock:
+            if not final and time.monotonic() - last_edit < PROGRESS_EDIT_INTERVAL:
+                return
+            last_edit = time.monotonic()
+            try:
+                await reply.edit_text(render())
+            except BadRequest as e:
+                if "not modified" not in str(e):
+                    raise
+
+    async def on_result(name, result):
+        status[name] = describe_outcome(result)
+        await refresh()
+
+    reply = await message.reply_text(render())
+    await fan_out(names, action, on_result)
+    await refresh(final=True)
+
+async def handle_note_all(update: Update, context: ContextTypes.DEFAULT_TYPE, audience=0):
+    if update.effective_user.id != ALLOWED_USER_ID:
+        return
+    args = list(context.args)
+    names = list(account_list)
+    if args and args[0].startswith('@'):
+        names = parse_selector(args.pop(0)[1:])
+        if not names:
+            await update.message.reply_text("Unknown accounts. Use e.g. @all, @1,3, @2-4 or @personal,work")
+            return
+    if not args:
+        await update.message.reply_text("Please add your note text after the command.")
+        return
+    text = ' '.join(args)
+    if len(text) > 60:
+        await update.message.reply_text("Too long! Max 60 characters.")
+        return
+
+    async def post(name):
+        note = await queued_write(name, 'post', text=text, audience=audience)
+        return f"✅ '{note.text}'"
+
+    aud = "Close Friends" if audience == 1 else "Mutual Followers"
+    await run_with_progress(update.message, f"Posting to {aud} on {len(names)} account(s):", names, post)
+
+async def note_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await handle_note_all(update, context, audience=0)
+
+async def note_all_cf(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await handle_note_all(update, context, audience=1)
+
+async def delete_notes(update: Update, selector):
+    names = parse_selector(selector)
+    if not names:
+        await update.message.reply_text("Unknown accounts. Use e.g. all, 1,3, 2-4 or personal,work")
+        return
+
+    async def delete(name):
+        return "🗑️ Deleted" if await queued_write(name, 'delete') else "No active note"
+
+    await run_with_progress(update.message, f"Deleting notes on {len(names)} account(s):", names, delete)
+
+# ==================== Scheduled Notes ====================
+UNITS = {'m': 60, 'h': 3600, 'd': 86400}
+
+def parse_interval(spec):
+    match = re.fullmatch(r'(\d+)([mhd])', spec.lower())
+    return int(match[1]) * UNITS[match[2]] if match else None
+
+def parse_when(spec):
+    """Unix time for "HH:MM" (next occurrence), "YYYY-MM-DDTHH:MM" or "+30m"/"+2h"/"+1d".
+
+    None if the spec is invalid or names a minute that has already passed.
+    """
+    now = datetime.now()
+    if spec.startswith('+'):
+        seconds = parse_interval(spec[1:])
+        return now.timestamp() + seconds if seconds else None
+    match = re.fullmatch(r'(\d{1,2}):(\d{2})', spec)
+    if match:
+        try:
+            when = now.replace(hour=int(match[1]), minute=int(match[2]), second=0, microsecond=0)
+        except ValueError:
+            return None
+        if when <= now:
+            when += timedelta(days=1)
+        return when.timestamp()
+    try:
+        when = datetime.strptime(spec, '%Y-%m-%dT%H:%M')
+    except ValueError:
+        return None
+    if when < now.replace(second=0, microsecond=0):
+        return None
+    return when.timestamp()
+
+def describe_schedule(row):
+    names = json.loads(row['accounts'])
+    who = "all accounts" if names == account_list else ", ".join(names)
+    repeat = f", every {format_interval(row['every'])}" if row['every'] else ""
+    when = datetime.fromtimestamp(row['run_at']).strftime('%Y-%m-%d %H:%M')
+    aud = " (Close Friends)" if row['audience'] == 1 else ""
+    return f"#{row['id']} {when}{repeat} → {who}{aud}: '{row['text']}'"
+
+def format_interval(seconds):
+    for unit, size in (('d', 86400), ('h', 3600)):
+        if seconds % size == 0:
+            return f"{int(seconds // size)}{unit}"
+    return f"{int(seconds // 60)}m"
+
+async def handle_note_at(update: Update, context: ContextTypes.DEFAULT_TYPE, audience=0):
+    if update.effective_user.id != ALLOWED_USER_ID:
+        return
+    usage = ("Usage: /note_at <when> [every <interval>] [@accounts] <text>\n"
+             "when: 09:30, 2025-01-31T09:30 (not in the past) or +45m / +2h / +1d\n"
+             "interval: 30m, 6h, 1d...")
+    args = list(context.args)
+    run_at = parse_when(args.pop(0)) if args else None
+    if run_at is None:
+        await update.message.reply_text(usage)
+        return
+    every = None
+    if len(args) >= 2 and args[0].lower() == 'every':
+        every = parse_interval(args[1])
+        if not every or every < 600:
+            await update.message.reply_text("Repeat interval must be at least 10m.\n\n" + usage)
+            return
+        args = args[2:]
+    names = list(account_list)
+    if args and args[0].startswith('@'):
+        names = parse_selector(args.pop(0)[1:])
+        if not names:
+            await update.message.reply_text("Unknown accounts. Use e.g. @all, @1,3, @2-4 or @personal,work")
+            return
+    text = ' '.join(args)
+    if not text:
+        await update.message.reply_text(usage)
+        return
+    if len(text) > 60:
+        await update.message.reply_text("Too long! Max 60 characters.")
+        return
+    schedule_id = db_execute("INSERT INTO schedules (run_at, every, accounts, text, audience) VALUES (?, ?, ?, ?, ?)",
+                             (run_at, every, json.dumps(names), text, audience)).lastrowid
+    row = db_query("SELECT * FROM schedules WHERE id = ?", (schedule_id,))[0]
+    if context.job_queue:
+        context.job_queue.run_once(run_due_schedules, max(0, run_at - time.time()), name="schedules")
+    await update.message.reply_text(f"⏰ Scheduled {describe_schedule(row)}")
+
+async def note_at(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await handle_note_at(update, context, audience=0)
+
+async def note_at_cf(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await handle_note_at(update, context, audience=1)
+
+async def schedules(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ALLOWED_USER_ID:
+        return
+    rows = db_query("SELECT * FROM schedules ORDER BY run_at")
+    if not rows:
+        await update.message.reply_text("No scheduled notes.")
+        return
+    await update.message.reply_text("⏰ Scheduled notes:\n" + "\n".join(map(describe_schedule, rows)))
+
+async def unschedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ALLOWED_USER_ID:
+        return
+    ids = [arg.lstrip('#') for arg in context.args]
+    if not ids or not all(i.isdigit() for i in ids):
+        await update.message.reply_text("Usage: /unschedule <id> [id...] (see /schedules)")
+        return
+    removed = 0
+    for schedule_id in ids:
+        removed += db_execute("DELETE FROM schedules WHERE id = ?", (int(schedule_id),)).rowcount
+    await update.message.reply_text(f"Removed {removed} scheduled note(s).")
+
+schedule_lock = asyncio.Lock()
+
+async def run_due_schedules(context: ContextTypes.DEFAULT_TYPE):
+    """Post every scheduled note that is due, including ones missed while the bot was down.
+
+    Due notes are coalesced per minute slot into one batch that posts to all its
+    accounts in parallel; if one slot targets an account twice, the newest
+    schedule wins since an account only has one note. A missed repeating
+    schedule is caught up once and then moved to its next future time.
+    """
+    if schedule_lock.locked():
+        return
+    async with schedule_lock:
+        ig_priority.set('background')
+        now = time.time()
+        due = db_query("SELECT * FROM schedules WHERE run_at <= ? ORDER BY run_at, id", (now,))
+        slots = {}
+        for row in due:
+            slots.setdefault(int(row['run_at'] // 60), []).append(row)
+        for rows in slots.values():
+            batch = {}
+            for row in rows:
+                for name in json.loads(row['accounts']):
+                    if name in accounts:
+                        batch[name] = row
+
+            async def post(name):
+                note = await queued_write(name, 'post', text=batch[name]['text'], audience=batch[name]['audience'])
+                return f"✅ '{note.text}'"
+
+            names = [name for name in account_list if name in batch]
+            results = await fan_out(names, post)
+            for row in rows:
+                if row['every']:
+                    run_at = row['run_at'] + row['every']
+                    if run_at <= now:
+                        run_at += (now - run_at) // row['every'] * row['every'] + row['every']
+                    db_execute("UPDATE schedules SET run_at = ? WHERE id = ?", (run_at, row['id']))
+                else:
+                    db_execute("DELETE FROM schedules WHERE id = ?", (row['id'],))
+            ids = ", ".join(f"#{row['id']}" for row in rows)
+            late = now - rows[0]['run_at'] > SCHEDULE_TICK * 2
+            caught_up = f" (caught up, were due {format_time(rows[0]['run_at'])})" if late else ""
+            lines = [f"⏰ Scheduled note(s) {ids}{caught_up}:"]
+            for name, result in zip(names, results):
+                lines.append(f"{account_list.index(name) + 1}. {name}: {describe_outcome(result)}")
+            try:
+                await context.bot.send_message(ALLOWED_USER_ID, "\n".join(lines))
+            except Exception as e:
+                logger.warning(f"Could not report scheduled notes: {e}")
+
+def start_scheduler(app):
+    if app.job_queue is None:
+        logger.warning("Scheduled notes need the job queue: pip install \"python-telegram-bot[job-queue]\"")
+        return
+    # First run right away catches up on anything that fell due while the bot was down
+    app.job_queue.run_repeating(run_due_schedules, SCHEDULE_TICK, first=0, name="schedules")
+
+# ==================== Pinned Notes ====================
+# A pinned account gets its note re-posted shortly before Instagram's 24h
+# expiry, so it stays up until unpinned, replaced or deleted through the bot.
+
+async def handle_pin_note(update: Update, context: ContextTypes.DEFAULT_TYPE, audience=0):
+    if update.effective_user.id != ALLOWED_USER_ID:
+        return
+    args = list(context.args)
+    if not args:
+        rows = db_query("SELECT * FROM pins")
+        lines = [f"📌 {row['account']}{' (Close Friends)' if row['audience'] == 1 else ''}: '{row['text']}'"
+                 for row in sorted(rows, key=lambda row: account_list.index(row['account']))
+                 if row['account'] in accounts]
+        await update.message.reply_text("\n".join(lines) if lines else
+                                        "Nothing pinned. Usage: /pin_note [@accounts] <text>")
+        return
+    names = list(account_list)
+    if args[0].startswith('@'):
+        names = parse_selector(args.pop(0)[1:])
+        if not names:
+            await update.message.reply_text("Unknown accounts. Use e.g. @all, @1,3, @2-4 or @personal,work")
+            return
+    text = ' '.join(args)
+    if not text:
+        await update.message.reply_text("Please add your note text after the command.")
+        return
+    if len(text) > 60:
+        await update.message.reply_text("Too long! Max 60 characters.")
+        return
+    for name in names:
+        db_execute("INSERT OR REPLACE INTO pins (account, text, audience) VALUES (?, ?, ?)", (name, text, audience))
+        pin_failures.pop(name, None)
+
+    async def post(name):
+        note = await queued_write(name, 'pin', text=text, audience=audience)
+        return f"📌 '{note.text}'"
+
+    await run_with_progress(update.message, f"Pinning a note on {len(names)} account(s):", names, post)
+
+async def pin_note(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await handle_pin_note(update, context, audience=0)
+
+async def pin_note_cf(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await handle_pin_note(update, context, audience=1)
+
+async def unpin_note(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ALLOWED_USER_ID:
+        return
+    names = parse_selector(','.join(context.args) or 'all')
+    if not names:
+        await update.message.reply_text("Unknown accounts. Use e.g. all, 1,3, 2-4 or personal,work")
+        return
+    removed = sum(db_execute("DELETE FROM pins WHERE account = ?", (name,)).rowcount for name in names)
+    await update.message.reply_text(f"Unpinned {removed} account(s). Their current notes stay up until they expire.")
+
+pin_failures = {}  # account -> error of its last failed refresh, already reported
+
+def pin_is_current(name, pin):
+    stored = own_notes.get(name)
+    return (stored is not None and stored['text'] == pin['text'] and stored['audience'] == pin['audience']
+            and stored['expires_at'] - time.time() > PIN_MARGIN)
+
+async def refresh_pin(context: ContextTypes.DEFAULT_TYPE):
+    name = context.job.data
+    ig_priority.set('background')
+    rows = db_query("SELECT * FROM pins WHERE account = ?", (name,))
+    if not rows or pin_is_current(name, rows[0]):
+        return
+    pin = rows[0]
+    if db_query("SELECT 1 FROM write_jobs WHERE account = ? AND (status = 'pending' OR status = 'dead' AND op = 'pin')",
+                (name,)):
+        return  # let a queued write land first; a dead pin write waits for /retry_dead or /drop_dead
+    try:
+        cl = await aget_client(name)
+        if not cl:
+            raise RuntimeError("Login failed")
+        if name not in own_notes:
+            # Never posted through the bot: the tray tells whether the pin is already up
+            await get_own_note(cl)
+            if pin_is_current(name, pin):
+                return
+        await queued_write(name, 'pin', text=pin['text'], audience=pin['audience'])
+        logger.info(f"Re-posted pinned note for {name}")
+        if pin_failures.pop(name, None):
+            await context.bot.send_message(ALLOWED_USER_ID, f"📌 The pinned note on {name} is back up.")
+    except WriteQueued as e:
+        logger.info(f"Pinned note for {name} is {e}")
+    except Exception as e:
+        logger.warning(f"Pinned note refresh failed for {name}: {e}")
+        if name in pin_failures:
+            return  # reported already; don't repeat it every PIN_CHECK
+        pin_failures[name] = str(e)
+        if accounts[name]['status'] in ('2fa', 'failed'):
+            retry = "It is re-posted once the account is logged in again."
+        else:
+            retry = f"Retrying every {PIN_CHECK / 60:g} min."
+        await context.bot.send_message(ALLOWED_USER_ID, f"📌 Could not refresh the pinned note on {name}: {e}\n{retry}")
+
+async def check_pins(context: ContextTypes.DEFAULT_TYPE):
+    """Queue a refresh for every pinned note that is missing or close to expiring.
+
+    The check itself only reads local state; the refreshes are spread
+    PIN_STAGGER apart so the accounts don't all post in the same second.
+    Accounts waiting for 2FA or whose login failed are left alone: retrying the
+    login every PIN_CHECK wouldn't fix it, and a command on the account will.
+    """
+    due = [row['account'] for row in db_query("SELECT * FROM pins")
+           if row['account'] in accounts and accounts[row['account']]['status'] not in ('2fa', 'failed')
+           and not pin_is_current(row['account'], row)]
+    for i, name in enumerate(sorted(due, key=account_list.index)):
+        if not context.job_queue.get_jobs_by_name(f"refresh_pin:{name}"):
+            context.job_queue.run_once(refresh_pin, i * PIN_STAGGER, data=name, name=f"refresh_pin:{name}")
+
+def start_pin_refresh(app):
+    if app.job_queue is None:
+        logger.warning("Pinned notes need the job queue: pip install \"python-telegram-bot[job-queue]\"")
+        return
+    app.job_queue.run_repeating(check_pins, PIN_CHECK, first=PIN_STAGGER, name="check_pins")
+
 # ==================== Handlers ====================
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ALLOWED_USER_ID:
@@ -148,12 +1879,47 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Available Commands:\n\n"
         "/note <message> → Post to mutual followers\n"
         "/note_cf <message> → Post to Close Friends\n"
+        "/note_all [@1,3|@all] <message> → Post to several accounts at once\n"
+        "/note_all_cf [@1,3|@all] <message> → Same, to Close Friends\n"
         "/current_note → Show current note(s)\n"
-        "/delete_note → Delete current note\n"
-        "/note_replies → Check recent replies\n\n"
+        "/delete_note [all|1,3] → Delete current note(s)\n"
+        "/note_replies → Check recent replies\n"
+        "/note_at <when> [every <interval>] [@1,3] <message> → Schedule a note\n"
+        "/schedules → List scheduled notes\n"
+        "/unschedule <id> → Remove a scheduled note\n"
+        "/pin_note [@1,3] <message> → Keep a note up, re-posting it before it expires\n"
+        "/unpin_note [all|1,3] → Stop re-posting\n"
+        "/dead_letters → Writes that kept failing\n"
+        "/retry_dead <id|all> → Queue them again\n"
+        "/drop_dead <id|all> → Discard them\n"
+        "/status → Show which accounts are logged in\n"
+        "/code <account> <code> → Finish a 2FA login\n\n"
         "Example: /note Hello from Telegram! 🚀"
     )
 
+async def ask_for_account(update: Update, question, action):
+    """Ask which account `action` is for, with one button per account."""
+    token = pending_action.add(action)
+    buttons = [[InlineKeyboardButton(f"{i}. {name} (@{accounts[name]['username']})", callback_data=f"{token}:{i - 1}")]
+               for i, name in enumerate(account_list, 1)]
+    buttons.append([InlineKeyboardButton("Cancel", callback_data=f"{token}:cancel")])
+    await update.message.reply_text(question, reply_markup=InlineKeyboardMarkup(buttons))
+
+async def run_action(name, action):
+    """Carry out a single-account /note or /delete_note and return the reply."""
+    try:
+        if action['type'] == 'note':
+            note = await queued_write(name, 'post', text=action['text'], audience=action['audience'])
+            aud = "Close Friends" if action['audience'] == 1 else "Mutual Followers"
+            return f"Posted to {aud} (@{accounts[name]['username']}):\n'{note.text}'"
+        if await queued_write(name, 'delete'):
+            return "Note deleted successfully."
+        return "No active note to delete."
+    except WriteQueued as e:
+        return f"⏳ Not done yet: {e}"
+    except Exception as e:
+        return f"Failed: {e}"
+
 async def handle_note_command(update: Update, context: ContextTypes.DEFAULT_TYPE, audience=0):
     user_id = update.effective_user.id
     if user_id != ALLOWED_USER_ID:
@@ -167,24 +1933,10 @@ async def handle_note_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
 
     if len(account_list) == 1:
-        name = account_list[0]
-        cl = get_client(name)
-        if not cl:
-            await update.message.reply_text("Login failed. Send 2FA code if prompted.")
-            return
-        try:
-            note = cl.create_note(text, audience=audience)
-            aud = "Close Friends" if audience == 1 else "Mutual Followers"
-            await update.message.reply_text(f"Posted to {aud} (@{accounts[name]['username']}):\n'{note.text}'")
-        except Exception as e:
-            await update.message.reply_text(f"Failed: {str(e)}")
+        action = {'type': 'note', 'text': text, 'audience': audience}
+        await update.message.reply_text(await run_action(account_list[0], action))
     else:
-        pending_action[user_id] = {'type': 'note', 'text': text, 'audience': audience}
-        lines = ["Which account?"]
-        for i, name in enumerate(account_list, 1):
-            lines.append(f"{i}. {name} (@{accounts[name]['username']})")
-        lines.append("\nReply with the number (1, 2, 3...)")
-        await update.message.reply_text("\n".join(lines))
+        await ask_for_account(update, "Which account?", {'type': 'note', 'text': text, 'audience': audience})
 
 async def note(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await handle_note_command(update, context, audience=0)
@@ -196,19 +1948,22 @@ async def current_note(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if user_id != ALLOWED_USER_ID:
         return
-    lines = ["Current notes:"]
-    for i, name in enumerate(account_list, 1):
-        cl = get_client(name)
+
+    async def lookup(name):
+        cl = await aget_client(name)
         if not cl:
-            lines.append(f"{i}. {name}: Login failed")
-            continue
-        try:
-            notes = cl.get_notes()
-            active = next((n for n in notes if n.user.pk == cl.user_id), None)
-            status = f"'{active.text}'" if active else "(none)"
-            lines.append(f"{i}. {name} (@{accounts[name]['username']}): {status}")
-        except Exception as e:
-            lines.append(f"{i}. {name}: Error - {e}")
+            return f"{name}: Login failed"
+        active = await get_own_note(cl)
+        status = f"'{active.text}'" if active else "(none)"
+        return f"{name} (@{accounts[name]['username']}): {status}"
+
+    results = await fan_out(account_list, lookup)
+    user_cache.save()
+    lines = ["Current notes:"]
+    for i, (name, result) in enumerate(zip(account_list, results), 1):
+        if isinstance(result, Exception):
+            result = f"{name}: {describe_failure(result)}"
+        lines.append(f"{i}. {result}")
     await update.message.reply_text("\n".join(lines))
 
 async def delete_note(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -216,140 +1971,242 @@ async def delete_note(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user_id != ALLOWED_USER_ID:
         return
 
-    if len(account_list) == 1:
-        name = account_list[0]
-        cl = get_client(name)
-        if not cl:
-            await update.message.reply_text("Login failed.")
-            return
-        try:
-            notes = cl.get_notes()
-            active = next((n for n in notes if n.user.pk == cl.user_id), None)
-            if active:
-                cl.delete_note(active.id)
-                await update.message.reply_text("Note deleted successfully.")
-            else:
-                await update.message.reply_text("No active note to delete.")
-        except Exception as e:
-            await update.message.reply_text(f"Error: {e}")
+    if context.args:
+        await delete_notes(update, ','.join(context.args))
+    elif len(account_list) == 1:
+        await update.message.reply_text(await run_action(account_list[0], {'type': 'delete_note'}))
     else:
-        pending_action[user_id] = {'type': 'delete_note'}
-        lines = ["Delete note from which account?"]
-        for i, name in enumerate(account_list, 1):
-            lines.append(f"{i}. {name} (@{accounts[name]['username']})")
-        lines.append("\nReply with the number")
-        await update.message.reply_text("\n".join(lines))
+        await ask_for_account(update, "Delete note from which account?", {'type': 'delete_note'})
 
 async def note_replies(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if user_id != ALLOWED_USER_ID:
         return
-    replies_list = []
-    for i, name in enumerate(account_list, 1):
-        cl = get_client(name)
+
+    async def lookup(name):
+        cl = await aget_client(name)
         if not cl:
-            replies_list.append(f"{i}. {name}: Login failed")
-            continue
-        try:
-            threads = cl.direct_threads(amount=20)
-            recent = []
-            for thread in threads:
-                msgs = cl.direct_messages(thread.id, amount=10)
-                for msg in reversed(msgs):
-                    if msg.timestamp < datetime.now() - timedelta(hours=24):
-                        continue
-                    if msg.user_id != cl.user_id:  # Message from someone else
-                        # Robust sender username extraction
-                        sender_username = "unknown"
-                        if hasattr(msg, 'sender') and msg.sender:
-                            sender_username = msg.sender.username
-                        elif hasattr(msg, 'user_id'):
-                            try:
-                                user = cl.user_info(msg.user_id)
-                                sender_username = user.username
-                            except:
-                                sender_username = f"user_{msg.user_id}"
-                        
-                        text = msg.text or "[media/emoji/reel]"
-                        time = msg.timestamp.strftime('%H:%M')
-                        recent.append(f"@{sender_username}: {text} ({time})")
-            status = "\n".join(recent[-8:]) if recent else "No recent replies"
-            replies_list.append(f"{i}. {name} (@{accounts[name]['username']}):\n{status}")
-        except Exception as e:
-            replies_list.append(f"{i}. {name}: Error - {str(e)}")
+            return f"{name}: Login failed"
+        replies, _ = await update_replies(cl)
+        recent = [f"@{sender}: {text} ({format_time(timestamp)})" for timestamp, sender, text in replies[-8:]]
+        status = "\n".join(recent) if recent else "No recent replies"
+        return f"{name} (@{accounts[name]['username']}):\n{status}"
+
+    results = await fan_out(account_list, lookup)
+    user_cache.save()
+    reply_cursors.save()
+    replies_list = []
+    for i, (name, result) in enumerate(zip(account_list, results), 1):
+        if isinstance(result, Exception):
+            result = f"{name}: {describe_failure(result)}"
+        replies_list.append(f"{i}. {result}")
     await update.message.reply_text("📨 Recent replies/reactions (last 24h):\n\n" + "\n\n".join(replies_list))
 
+STATUS_LABELS = {
+    'cold': "⏳ not logged in yet",
+    'warming': "⏳ logging in...",
+    'ready': "✅ ready",
+    '2fa': "🔐 waiting for 2FA code",
+    'failed': "❌ login failed",
+}
+
+def account_status_lines():
+    pending_2fa()  # let expired 2FA challenges fall back to "not logged in yet"
+    return [f"{i}. {name} (@{accounts[name]['username']}): {STATUS_LABELS[accounts[name]['status']]}"
+            for i, name in enumerate(account_list, 1)]
+
+async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ALLOWED_USER_ID:
+        return
+    await update.message.reply_text("Accounts:\n" + "\n".join(account_status_lines()))
+
+async def submit_2fa(update: Update, name, code):
+    await update.message.reply_text(f"Verifying 2FA code for {name}...")
+    try:
+        await run_blocking(name, complete_2fa, name, code)
+        await update.message.reply_text(f"2FA successful for {name}! Session saved.")
+    except Exception as e:
+        # The challenge stays open until TWO_FACTOR_TTL, so a mistyped code can be sent again
+        await update.message.reply_text(f"2FA failed for {name}: {str(e)}")
+
+async def code(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ALLOWED_USER_ID:
+        return
+    waiting = pending_2fa()
+    if len(context.args) != 2:
+        hint = f"Waiting for: {', '.join(waiting)}" if waiting else "No account is waiting for a code."
+        await update.message.reply_text(f"Usage: /code <account> <code>\n{hint}")
+        return
+    names = parse_selector(context.args[0])
+    if not names or len(names) != 1 or names[0] not in waiting:
+        await update.message.reply_text(f"{context.args[0]} is not waiting for a 2FA code. "
+                                        f"Waiting: {', '.join(waiting) or 'none'}")
+        return
+    await submit_2fa(update, names[0], context.args[1])
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     text = update.message.text.strip()
 
-    # 2FA handling
-    global waiting_for_2fa
-    if waiting_for_2fa and user_id == ALLOWED_USER_ID:
-        if text.isdigit() and len(text) == 6:
-            name = waiting_for_2fa
-            data = accounts[name]
-            await update.message.reply_text("Verifying 2FA code...")
-            try:
-                cl = Client()
-                cl.delay_range = [1, 5]
-                cl.login(data['username'], data['password'], verification_code=int(text))
-                cl.dump_settings(data['session_file'])
-                accounts[name]['client'] = cl
-                waiting_for_2fa = None
-                await update.message.reply_text(f"2FA successful for {name}! Session saved.")
-            except Exception as e:
-                waiting_for_2fa = None
-                await update.message.reply_text(f"2FA failed: {str(e)}")
-            return
+    # A bare 6-digit code is only unambiguous while a single account waits for one
+    if user_id == ALLOWED_USER_ID and text.isdigit() and len(text) == 6:
+        waiting = pending_2fa()
+        if len(waiting) == 1:
+            await submit_2fa(update, waiting[0], text)
+        elif waiting:
+            await update.message.reply_text(f"Several accounts are waiting for a code ({', '.join(waiting)}). "
+                                            f"Send it as /code <account> {text}")
 
-    # Account selection for pending actions
-    if user_id in pending_action and text.isdigit():
-        choice = int(text)
-        if 1 <= choice <= len(account_list):
-            name = account_list[choice - 1]
-            cl = get_client(name)
-            if not cl:
-                await update.message.reply_text("Login failed. Send 2FA code if prompted.")
-                return
-            action = pending_action.pop(user_id)
-            if action['type'] == 'note':
-                try:
-                    note = cl.create_note(action['text'], audience=action['audience'])
-                    aud = "Close Friends" if action['audience'] == 1 else "Mutual Followers"
-                    await update.message.reply_text(f"Posted to {aud} (@{accounts[name]['username']}):\n'{note.text}'")
-                except Exception as e:
-                    await update.message.reply_text(f"Failed: {str(e)}")
-            elif action['type'] == 'delete_note':
-                try:
-                    notes = cl.get_notes()
-                    active = next((n for n in notes if n.user.pk == cl.user_id), None)
-                    if active:
-                        cl.delete_note(active.id)
-                        await update.message.reply_text("Note deleted successfully.")
-                    else:
-                        await update.message.reply_text("No active note to delete.")
-                except Exception as e:
-                    await update.message.reply_text(f"Error: {e}")
+async def handle_account_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """A button under an account keyboard was pressed: run the action in place of the question."""
+    query = update.callback_query
+    await query.answer()
+    if update.effective_user.id != ALLOWED_USER_ID:
+        return
+    token, _, choice = query.data.partition(':')
+    action = pending_action.take(token)
+    if action is None:
+        await query.edit_message_text("This selection has expired or was already used. Run the command again.")
+        return
+    if choice == 'cancel':
+        await query.edit_message_text("Cancelled.")
+        return
+    name = account_list[int(choice)]
+    verb = "Posting to" if action['type'] == 'note' else "Deleting note on"
+    await query.edit_message_text(f"{verb} {name} (@{accounts[name]['username']})...")
+    await query.edit_message_text(await run_action(name, action))
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     logger.error("Exception occurred:", exc_info=context.error)
 
+# ==================== Background Jobs ====================
+async def poll_replies(context: ContextTypes.DEFAULT_TYPE):
+    """Check one account's inbox and push replies that arrived since the last check.
+
+    Each run schedules the next one: the interval snaps back to REPLY_POLL_MIN
+    after new replies and doubles up to REPLY_POLL_MAX while the inbox is quiet.
+    """
+    job = context.job
+    name, interval = job.data['name'], job.data['interval']
+    ig_priority.set('background')
+    try:
+        cl = await aget_client(name)
+        if not cl:
+            interval = REPLY_POLL_MAX
+        else:
+            # The first poll without stored cursors only records where the inbox is
+            seeded = name in reply_cursors
+            _, new = await update_replies(cl)
+            reply_cursors.save()
+            user_cache.save()
+            if new and seeded:
+                lines = [f"📨 New replies for {name} (@{accounts[name]['username']}):"]
+                lines += [f"@{sender}: {text} ({format_time(timestamp)})" for timestamp, sender, text in new]
+                await context.bot.send_message(ALLOWED_USER_ID, "\n".join(lines))
+            interval = REPLY_POLL_MIN if new else min(interval * 2, REPLY_POLL_MAX)
+    except Exception as e:
+        logger.warning(f"Reply poll failed for {name}: {e}")
+        interval = REPLY_POLL_MAX
+    finally:
+        context.job_queue.run_once(poll_replies, interval, data={'name': name, 'interval': interval},
+                                   name=f"poll_replies:{name}")
+
+async def warm_up_accounts(app):
+    """Log in to every account in the background and report when all have settled.
+
+    Each account holds its own lock while it logs in, so commands for accounts
+    that are already warm run right away and the rest wait only for their own
+    login instead of repeating it.
+    """
+    for name in account_list:
+        if accounts[name]['status'] == 'cold':
+            accounts[name]['status'] = 'warming'
+    results = await fan_out(account_list, aget_client)
+    for name, result in zip(account_list, results):
+        if isinstance(result, Exception):
+            accounts[name]['status'] = 'failed'
+            logger.error(f"Warm-up failed for {name}: {result}")
+    ready = sum(accounts[name]['status'] == 'ready' for name in account_list)
+    logger.info(f"Warm-up finished: {ready}/{len(account_list)} account(s) ready")
+    text = f"🚀 Bot started, {ready}/{len(account_list)} account(s) ready:\n" + "\n".join(account_status_lines())
+    waiting = pending_2fa()
+    if waiting:
+        text += f"\n\n🔐 Send the 2FA codes as /code <account> <code>, e.g. /code {waiting[0]} 123456"
+    try:
+        await app.bot.send_message(ALLOWED_USER_ID, text)
+    except Exception as e:
+        logger.warning(f"Could not send warm-up report: {e}")
+
+async def post_shutdown(app):
+    stop_shards()
+    if METRICS_FILE:
+        write_metrics_file()
+
+async def post_init(app):
+    start_shards()
+    start_write_workers(app.bot)
+    await start_metrics(app)
+    if WARM_UP:
+        # Not awaited: polling starts while the accounts log in
+        app.bot_data['warm_up'] = asyncio.create_task(warm_up_accounts(app))
+
+def schedule_reply_polls(app):
+    if app.job_queue is None:
+        logger.warning("REPLY_POLL needs the job queue: pip install \"python-telegram-bot[job-queue]\"")
+        return
+    for i, name in enumerate(account_list):
+        # Spread the first polls so the accounts don't all hit Instagram together
+        first = REPLY_POLL_MIN * i / len(account_list)
+        app.job_queue.run_once(poll_replies, first, data={'name': name, 'interval': REPLY_POLL_MIN},
+                               name=f"poll_replies:{name}")
+    logger.info(f"Polling replies for {len(account_list)} account(s)")
+
 # ==================== Main ====================
 def main():
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    # Handlers await Instagram work on account threads, so let updates run side by side
+    app = (Application.builder().token(TELEGRAM_BOT_TOKEN).concurrent_updates(True)
+           .post_init(post_init).post_shutdown(post_shutdown).build())
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("note", note))
     app.add_handler(CommandHandler("note_cf", note_cf))
+    app.add_handler(CommandHandler("note_all", note_all))
+    app.add_handler(CommandHandler("note_all_cf", note_all_cf))
     app.add_handler(CommandHandler("current_note", current_note))
     app.add_handler(CommandHandler("delete_note", delete_note))
     app.add_handler(CommandHandler("note_replies", note_replies))
+    app.add_handler(CommandHandler("note_at", note_at))
+    app.add_handler(CommandHandler("note_at_cf", note_at_cf))
+    app.add_handler(CommandHandler("schedules", schedules))
+    app.add_handler(CommandHandler("unschedule", unschedule))
+    app.add_handler(CommandHandler("pin_note", pin_note))
+    app.add_handler(CommandHandler("pin_note_cf", pin_note_cf))
+    app.add_handler(CommandHandler("unpin_note", unpin_note))
+    app.add_handler(CommandHandler("dead_letters", dead_letters))
+    app.add_handler(CommandHandler("retry_dead", retry_dead))
+    app.add_handler(CommandHandler("drop_dead", drop_dead))
+    app.add_handler(CommandHandler("status", status))
+    app.add_handler(CommandHandler("code", code))
+    app.add_handler(CallbackQueryHandler(handle_account_choice))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     app.add_error_handler(error_handler)
+    for handler in app.handlers[0]:
+        handler.callback = timed(handler.callback)
+
+    init_db()
+    start_scheduler(app)
+    start_pin_refresh(app)
+    if REPLY_POLL:
+        schedule_reply_polls(app)
 
-    print("Instagram Notes Bot is running! 🚀")
-    app.run_polling()
+    print(f"Instagram Notes Bot is running ({BOT_MODE})! 🚀")
+    if BOT_MODE == 'webhook':
+        # The embedded server rejects requests without the secret header, answers
+        # Telegram at once and hands the update to the same handlers as polling.
+        app.run_webhook(listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, url_path=urlparse(WEBHOOK_URL).path.lstrip('/'),
+                        webhook_url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    else:
+        app.run_polling()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
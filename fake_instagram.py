@@ -0,0 +1,371 @@
+"""
+Fake Instagram Backend
+
+A local stand-in for the parts of Instagram's private API the bot uses: login
+(including 2FA), session checks, the notes tray, posting and deleting notes,
+the direct inbox and threads, and user lookups. Use it to test and measure the
+bot without touching real accounts.
+
+Every account name is accepted with any password and gets a synthetic inbox.
+Latency, transient errors, expired sessions and 2FA can be injected.
+
+Usage:
+    python fake_instagram.py --port 8910 --latency 80 --jitter 40 --error-rate 0.02
+    INSTAGRAM_API_URL=http://127.0.0.1:8910 python bot.py
+
+With INSTAGRAM_API_URL set, the bot sends all Instagram traffic here. Start it
+without session files (or with ones issued by this backend): sessions from
+real Instagram are rejected.
+
+Inspection:
+    GET  /__fake/stats                       → request counts per account and endpoint
+    POST /__fake/reset                       → clear the counts
+    POST /__fake/reply?username=u&text=hi    → a new direct message for account u
+"""
+
+import re
+import json
+import time
+import base64
+import random
+import argparse
+import itertools
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from Cryptodome.PublicKey import RSA
+
+PROFILE_PIC = "https://instagram.invalid/profile.jpg"
+NOTE_TTL = 24 * 3600
+PEER_BASE = 5000  # pk of the first synthetic follower writing to every inbox
+
+class FakeInstagram:
+    """State and behaviour of the fake backend, safe to use from the server's handler threads.
+
+    latency / jitter: milliseconds added to every request (uniform jitter on top)
+    error_rate: share of requests answered with 429 (a transient failure)
+    login_required_rate: share of authenticated requests answered with login_required
+    session_ttl: seconds after which an issued session expires (0 = never)
+    two_factor: usernames whose logins need a code ('*' for all)
+    code: the only accepted 2FA code (any 6 digits if empty)
+    threads / messages: synthetic inbox size of every account
+    friends: other users with an active note in every account's tray
+    """
+
+    def __init__(self, latency=0, jitter=0, error_rate=0.0, login_required_rate=0.0, session_ttl=0,
+                 two_factor=(), code='', threads=20, messages=30, friends=10, seed=None):
+        self.latency = latency / 1000
+        self.jitter = jitter / 1000
+        self.error_rate = error_rate
+        self.login_required_rate = login_required_rate
+        self.session_ttl = session_ttl
+        self.two_factor = set(two_factor)
+        self.code = code
+        self.threads = threads
+        self.messages = messages
+        self.friends = friends
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(int(time.time() * 1000))
+        self.users = {}  # pk -> username
+        self.pks = {}  # username -> pk
+        self.notes = {}  # pk -> note dict
+        self.inboxes = {}  # pk -> [thread dict], most recent activity first
+        self.stats = {}  # username -> {endpoint: count}
+        self.key = RSA.generate(2048)
+        self.public_key = base64.b64encode(self.key.publickey().export_key()).decode()
+        now = time.time()
+        for i in range(friends):
+            pk = self.user(f"friend{i}")
+            self.notes[pk] = self.make_note(pk, f"friend note {i}", 0, now - i * 60)
+
+    # ---- state ----
+    def user(self, username):
+        with self.lock:
+            if username not in self.pks:
+                pk = 1000 + len(self.pks)
+                self.pks[username], self.users[pk] = pk, username
+            return self.pks[username]
+
+    def user_dict(self, pk):
+        return {'pk': pk, 'id': str(pk), 'username': self.users.get(pk, f"follower{pk - PEER_BASE}"), 'full_name': "",
+                'profile_pic_url': PROFILE_PIC, 'is_private': False, 'is_verified': False, 'is_business': False}
+
+    def make_note(self, pk, text, audience, created):
+        return {'note_id': str(next(self.ids)), 'text': text, 'author_id': pk, 'author': self.user_dict(pk),
+                'audience': audience, 'created_at': int(created), 'expires_at': int(created + NOTE_TTL)}
+
+    def inbox(self, pk):
+        with self.lock:
+            if pk not in self.inboxes:
+                self.inboxes[pk] = [self.make_thread(pk, i) for i in range(self.threads)]
+            return self.inboxes[pk]
+
+    def make_thread(self, pk, index):
+        peer = PEER_BASE + index
+        newest = time.time() - index * 600
+        items = [self.make_item(peer if j % 2 == 0 else pk, f"message {j} in thread {index}", newest - j * 30)
+                 for j in range(self.messages)]
+        return {'thread_id': f"{pk}{index:05d}", 'thread_v2_id': f"v2{pk}{index:05d}", 'peer': peer, 'items': items}
+
+    def make_item(self, user_id, text, timestamp):
+        return {'item_id': str(next(self.ids)), 'user_id': user_id, 'timestamp': int(timestamp * 1_000_000),
+                'item_type': 'text', 'text': text}
+
+    def add_reply(self, username, text):
+        pk = self.user(username)
+        threads = self.inbox(pk)
+        with self.lock:
+            thread = threads.pop(self.random.randrange(len(threads)))
+            thread['items'].insert(0, self.make_item(thread['peer'], text, time.time()))
+            threads.insert(0, thread)
+        return thread['thread_id']
+
+    def thread_json(self, pk, thread, items):
+        return {
+            'thread_id': thread['thread_id'], 'thread_v2_id': thread['thread_v2_id'], 'items': items,
+            'users': [self.user_dict(thread['peer'])], 'left_users': [], 'admin_user_ids': [],
+            'last_activity_at': thread['items'][0]['timestamp'] if thread['items'] else 0,
+            'muted': False, 'named': False, 'canonical': True, 'pending': False, 'archived': False,
+            'thread_type': 'private', 'thread_title': self.user_dict(thread['peer'])['username'], 'folder': 0, 'vc_muted': False,
+            'is_group': False, 'mentions_muted': False, 'approval_required_for_new_members': False,
+            'input_mode': 0, 'viewer_id': pk,
+        }
+
+    def count(self, username, endpoint):
+        with self.lock:
+            per_user = self.stats.setdefault(username or '-', {})
+            per_user[endpoint] = per_user.get(endpoint, 0) + 1
+
+    # ---- sessions ----
+    def authorization(self, pk):
+        data = {'ds_user_id': str(pk), 'sessionid': f"{pk}:{int(time.time())}:{self.random.getrandbits(32)}"}
+        return "Bearer IGT:2:" + base64.b64encode(json.dumps(data).encode()).decode()
+
+    def session_user(self, header):
+        """pk of a valid session in the Authorization header, or None."""
+        try:
+            data = json.loads(base64.b64decode(header.rsplit(':', 1)[-1]))
+            pk, issued, _ = data['sessionid'].split(':')
+            pk = int(pk)
+        except Exception:
+            return None
+        if pk not in self.users or (self.session_ttl and time.time() - int(issued) > self.session_ttl):
+            return None
+        return pk
+
+    def needs_code(self, username):
+        return '*' in self.two_factor or username in self.two_factor
+
+    # ---- endpoints ----
+    def handle(self, method, path, query, body, headers):
+        """Returns (status, json body, extra headers)."""
+        route = re.sub(r'\d{3,}', '{id}', path)
+        pk = self.session_user(headers.get('Authorization', ''))
+        self.count(self.users.get(pk), route)
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        if self.random.random() < self.error_rate:
+            return 429, {'message': "rate limited", 'status': 'fail'}, {}
+
+        if path == '/api/v1/launcher/sync/':
+            return 200, {'status': 'ok'}, {}
+        if path == '/api/v1/qe/sync/':
+            return 200, {'status': 'ok'}, {'ig-set-password-encryption-key-id': '1',
+                                           'ig-set-password-encryption-pub-key': self.public_key}
+        if path == '/api/v1/accounts/login/':
+            username = body.get('username', '')
+            if self.needs_code(username):
+                return 400, {'message': "", 'two_factor_required': True, 'error_type': 'two_factor_required',
+                             'two_factor_info': {'two_factor_identifier': username, 'username': username},
+                             'status': 'fail'}, {}
+            return self.logged_in(self.user(username))
+        if path == '/api/v1/accounts/two_factor_login/':
+            code = str(body.get('verification_code', ''))
+            if not re.fullmatch(r'\d{6}', code) or (self.code and code != self.code):
+                return 400, {'message': "Please check the security code and try again.",
+                             'error_type': 'sms_code_validation_code_invalid', 'status': 'fail'}, {}
+            return self.logged_in(self.user(body.get('two_factor_identifier') or body.get('username', '')))
+
+        if pk is None or self.random.random() < self.login_required_rate:
+            return 403, {'message': 'login_required', 'logout_reason': 2, 'status': 'fail'}, {}
+
+        if path == '/api/v1/accounts/current_user/':
+            return 200, {'user': self.user_dict(pk), 'status': 'ok'}, {}
+        if path in ('/api/v1/feed/timeline/', '/api/v1/feed/reels_tray/'):
+            return 200, {'feed_items': [], 'tray': [], 'more_available': False, 'status': 'ok'}, {}
+        if path == '/graphql/query':
+            return self.notes_tray(pk)
+        if path.rstrip('/') == '/api/v1/notes/create_note':
+            return self.create_note(pk, body)
+        if path == '/api/v1/notes/delete_note/':
+            return self.delete_note(pk, str(body.get('id', '')))
+        if path == '/api/v1/direct_v2/inbox/':
+            return self.direct_inbox(pk, query)
+        match = re.fullmatch(r'/api/v1/direct_v2/threads/(\w+)/', path)
+        if match:
+            return self.direct_thread(pk, match[1], query)
+        match = re.fullmatch(r'/api/v1/users/(\d+)/info/', path)
+        if match:
+            user = dict(self.user_dict(int(match[1])), media_count=0, follower_count=0, following_count=0)
+            return 200, {'user': user, 'status': 'ok'}, {}
+        return 404, {'message': f"fake_instagram has no {method} {path}", 'status': 'fail'}, {}
+
+    def logged_in(self, pk):
+        return 200, {'logged_in_user': self.user_dict(pk), 'status': 'ok'}, {'ig-set-authorization': self.authorization(pk)}
+
+    def notes_tray(self, pk):
+        now = time.time()
+        with self.lock:
+            notes = [note for note in self.notes.values() if note['expires_at'] > now]
+        items = [{'inbox_tray_item_id': note['note_id'], 'note_dict': note} for note in notes]
+        return 200, {'data': {'xdt_get_inbox_tray_items': {'inbox_tray_items': items}}, 'status': 'ok'}, {}
+
+    def create_note(self, pk, body):
+        note = self.make_note(pk, body.get('text', ''), int(body.get('audience', 0)), time.time())
+        with self.lock:
+            self.notes[pk] = note
+        return 200, {'id': note['note_id'], 'text': note['text'], 'user_id': str(pk), 'user': self.user_dict(pk),
+                     'audience': note['audience'], 'created_at': note['created_at'], 'expires_at': note['expires_at'],
+                     'is_emoji_only': False, 'has_translation': False, 'note_style': 0, 'status': 'ok'}, {}
+
+    def delete_note(self, pk, note_id):
+        with self.lock:
+            note = self.notes.get(pk)
+            if not note or note['note_id'] != note_id:
+                return 400, {'message': "Note not found", 'status': 'fail'}, {}
+            del self.notes[pk]
+        return 200, {'status': 'ok'}, {}
+
+    def direct_inbox(self, pk, query):
+        threads = self.inbox(pk)
+        start = int(query.get('cursor', 0) or 0)
+        limit = int(query.get('limit', 20))
+        per_thread = int(query.get('thread_message_limit', 10))
+        page = threads[start:start + limit]
+        more = start + limit < len(threads)
+        inbox = {'threads': [self.thread_json(pk, thread, thread['items'][:per_thread]) for thread in page],
+                 'has_older': more, 'oldest_cursor': str(start + limit) if more else None}
+        return 200, {'inbox': inbox, 'viewer': self.user_dict(pk), 'status': 'ok'}, {}
+
+    def direct_thread(self, pk, thread_id, query):
+        thread = next((t for t in self.inbox(pk) if t['thread_id'] == thread_id), None)
+        if thread is None:
+            return 404, {'message': "Thread not found", 'status': 'fail'}, {}
+        start = int(query.get('cursor', 0) or 0)
+        limit = int(query.get('limit', 20))
+        items = thread['items'][start:start + limit]
+        more = start + limit < len(thread['items'])
+        data = dict(self.thread_json(pk, thread, items), has_older=more,
+                    oldest_cursor=str(start + limit) if more else None)
+        return 200, {'thread': data, 'status': 'ok'}, {}
+
+def parse_body(raw, content_type):
+    """Form fields of a request; instagrapi's signed_body and raw JSON bodies are unpacked."""
+    if not raw:
+        return {}
+    text = raw.decode('utf-8', 'replace')
+    if 'json' in content_type or text.startswith('{'):
+        try:
+            return json.loads(text)
+        except ValueError:
+            return {}
+    form = {key: values[0] for key, values in parse_qs(text).items()}
+    if 'signed_body' in form:
+        try:
+            return json.loads(form['signed_body'].split('.', 1)[1])
+        except (IndexError, ValueError):
+            return {}
+    return form
+
+class Handler(BaseHTTPRequestHandler):
+    fake = None  # set by make_server
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # headers and body go out separately; don't stall on delayed ACKs
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        raw = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if url.path.startswith('/__fake/'):
+            status, body, headers = self.control(url.path, query)
+        else:
+            body = parse_body(raw, self.headers.get('Content-Type', ''))
+            status, body, headers = self.fake.handle(method, url.path, query, body, self.headers)
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def control(self, path, query):
+        if path == '/__fake/stats':
+            with self.fake.lock:
+                return 200, json.loads(json.dumps(self.fake.stats)), {}
+        if path == '/__fake/reset':
+            with self.fake.lock:
+                self.fake.stats.clear()
+            return 200, {'status': 'ok'}, {}
+        if path == '/__fake/reply' and query.get('username'):
+            thread_id = self.fake.add_reply(query['username'], query.get('text', "hello"))
+            return 200, {'thread_id': thread_id, 'status': 'ok'}, {}
+        return 404, {'message': "unknown control endpoint", 'status': 'fail'}, {}
+
+    def log_message(self, format, *args):
+        pass  # one line per request would drown out the bot's own log
+
+def make_server(fake, host='127.0.0.1', port=0):
+    """A ThreadingHTTPServer for `fake`; port 0 picks a free one (see server.server_address)."""
+    handler = type('BoundHandler', (Handler,), {'fake': fake})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+def start_in_background(fake, host='127.0.0.1', port=0):
+    """Serve `fake` from a daemon thread; returns (server, base URL for INSTAGRAM_API_URL)."""
+    server = make_server(fake, host, port)
+    threading.Thread(target=server.serve_forever, name='fake-instagram', daemon=True).start()
+    return server, f"http://{server.server_address[0]}:{server.server_address[1]}"
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for Instagram's private API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8910)
+    parser.add_argument('--latency', type=float, default=0, help="milliseconds added to every request")
+    parser.add_argument('--jitter', type=float, default=0, help="extra random milliseconds, up to this much")
+    parser.add_argument('--error-rate', type=float, default=0, help="share of requests answered with 429")
+    parser.add_argument('--login-required-rate', type=float, default=0,
+                        help="share of authenticated requests answered with login_required")
+    parser.add_argument('--session-ttl', type=float, default=0, help="seconds until an issued session expires")
+    parser.add_argument('--two-factor', default='', help="comma-separated usernames that need a 2FA code, or *")
+    parser.add_argument('--code', default='', help="the only accepted 2FA code (default: any 6 digits)")
+    parser.add_argument('--threads', type=int, default=20, help="direct threads per account")
+    parser.add_argument('--messages', type=int, default=30, help="messages per thread")
+    parser.add_argument('--friends', type=int, default=10, help="other users with a note in the tray")
+    parser.add_argument('--seed', type=int, help="random seed for repeatable runs")
+    args = parser.parse_args()
+
+    fake = FakeInstagram(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                         login_required_rate=args.login_required_rate, session_ttl=args.session_ttl,
+                         two_factor=[u.strip() for u in args.two_factor.split(',') if u.strip()], code=args.code,
+                         threads=args.threads, messages=args.messages, friends=args.friends, seed=args.seed)
+    server = make_server(fake, args.host, args.port)
+    print(f"Fake Instagram listening on http://{args.host}:{args.port} "
+          f"(set INSTAGRAM_API_URL=http://{args.host}:{args.port})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Webhook Test Harness
+
+Posts synthetic Telegram updates to a bot running with BOT_MODE=webhook, the
+way Telegram would, and reports how fast the webhook server answers.
+
+The updates come from ALLOWED_TELEGRAM_USER_ID, so the bot handles them like
+real commands and sends its replies to your Telegram chat.
+
+Usage:
+    python webhook_harness.py "/status"
+    python webhook_harness.py "/current_note" "/note_replies" --repeat 5 --concurrency 4
+    python webhook_harness.py --url http://127.0.0.1:8443/telegram "/status"
+
+Settings are read from .env (WEBHOOK_URL, WEBHOOK_PORT, WEBHOOK_SECRET,
+ALLOWED_TELEGRAM_USER_ID). Before the real updates, one request with a wrong
+secret is sent to check that the server turns it away.
+"""
+
+import os
+import json
+import time
+import argparse
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from dotenv import load_dotenv
+
+load_dotenv()
+
+def make_update(update_id, user_id, text):
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'Harness'},
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+def post(url, secret, update):
+    request = urllib.request.Request(url, data=json.dumps(update).encode(), method='POST', headers={
+        'Content-Type': 'application/json',
+        'X-Telegram-Bot-Api-Secret-Token': secret,
+    })
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return status, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Send synthetic updates to the bot's webhook server")
+    parser.add_argument('texts', nargs='+', help="message texts to send, e.g. /status")
+    parser.add_argument('--url', help="webhook endpoint (default: WEBHOOK_PORT and the path of WEBHOOK_URL on 127.0.0.1)")
+    parser.add_argument('--secret', default=os.getenv('WEBHOOK_SECRET', ''))
+    parser.add_argument('--user-id', type=int, default=int(os.getenv('ALLOWED_TELEGRAM_USER_ID', '0') or 0))
+    parser.add_argument('--repeat', type=int, default=1, help="send every text this many times")
+    parser.add_argument('--concurrency', type=int, default=1, help="requests in flight at once")
+    args = parser.parse_args()
+
+    url = args.url or (f"http://127.0.0.1:{os.getenv('WEBHOOK_PORT', '8443')}"
+                       f"{urlparse(os.getenv('WEBHOOK_URL', '')).path or '/'}")
+    base_id = int(time.time())
+
+    status, _ = post(url, args.secret + 'x', make_update(base_id, args.user_id, '/start'))
+    print(f"Wrong secret → HTTP {status} {'✅' if status == 403 else '❌ expected 403'}")
+
+    updates = [make_update(base_id + i, args.user_id, text)
+               for i, text in enumerate(args.texts * args.repeat, 1)]
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(lambda update: post(url, args.secret, update), updates))
+
+    for update, (status, elapsed) in zip(updates, results):
+        print(f"{update['message']['text']!r}: HTTP {status} in {elapsed * 1000:.1f} ms")
+    times = sorted(elapsed for _, elapsed in results)
+    failed = sum(status != 200 for status, _ in results)
+    print(f"\n{len(results)} update(s), {failed} failed, "
+          f"median {times[len(times) // 2] * 1000:.1f} ms, max {times[-1] * 1000:.1f} ms")
+
+if __name__ == '__main__':
+    main()